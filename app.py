@@ -1,9 +1,17 @@
 import streamlit as st
+from decouple import config
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from llm_values.models import engine, Topic, Answer, Setup, Question
+from llm_values.models import get_engine, Topic, Answer, Setup, Question
 from llm_values.utils.utils import load_json_file
-from llm_values.utils.visualize import get_plot_cached
+from llm_values.utils.visualize import get_plot_cached, get_chart_spec, get_stats_version
+
+# "png": pre-rendered matplotlib plots (see prerender_plots.py), "vega": Vega-Lite charts rendered by the browser
+chart_backend = config("CHART_BACKEND", default="png")
+
+# Seconds until the data cache (shared by all sessions) is loaded again from the database
+cache_ttl = config("APP_CACHE_TTL", default=600, cast=int)
 
 st.set_page_config(layout="wide")
 st.html("""<style>[alt=Logo] {height: 3rem;}</style>""")
@@ -28,6 +36,35 @@ def question_mode(mode: str):
         return "How much resources should we spend? (9=much more, 5=same as now, 1=nothing)"
 
 
+def load_stats_versions() -> dict[int, str]:
+    """Stats version per setup, not cached: one small query per rerun so that new stats are picked up at once"""
+    with Session(get_engine()) as session:
+        return {row.id: get_stats_version(row) for row in session.execute(
+            select(Setup.id, Setup.stats_version)
+        )}
+
+
+@st.cache_data(ttl=cache_ttl, show_spinner=False)
+def load_setups_and_topics(stats_versions: dict[int, str]):
+    """Setups (with their stats) and topics, loaded again when the stats version of any setup changes"""
+    with Session(get_engine()) as session:
+        return session.query(Setup).all(), {tpc.name: tpc for tpc in session.query(Topic).all()}
+
+
+@st.cache_data(ttl=cache_ttl, show_spinner=False)
+def load_questions(topic_id: int):
+    with Session(get_engine()) as session:
+        return session.query(Question).filter(Question.topic_id == topic_id).order_by(Question.number).all()
+
+
+@st.cache_data(ttl=cache_ttl, max_entries=1000, show_spinner=False)
+def load_answers(setup_id: int, question_id: int, stats_version: str):
+    """Answers of a question for a setup (the stats version invalidates the cache entry when new answers arrive)"""
+    with Session(get_engine()) as session:
+        setup = session.get(Setup, setup_id)
+        return session.query(Answer).filter(*setup.answer_filter(question_id=question_id)).all()
+
+
 def init_app():
     if not hasattr(st.session_state, 'initialized'):
         # st.session_state.data = {}
@@ -41,19 +78,19 @@ def init_app():
         st.session_state.discrepancies = {}
         st.session_state.plot = None
 
-        with Session(engine) as session:
-            st.session_state.setups = session.query(Setup).all()
-            st.session_state.setup_selected = None
-            st.session_state.topics = {tpc.name: tpc for tpc in session.query(Topic).all()}
-            st.session_state.topic_selected = None
+        st.session_state.setup_selected = None
+        st.session_state.topic_selected = None
+        st.session_state.stats_version = None
 
         st.session_state.languages = sorted(load_json_file("languages.json"))
 
 
 def main():
     languages = st.session_state.languages
+    stats_versions = load_stats_versions()
+    setups, topic_objects = load_setups_and_topics(stats_versions)
 
-    topics = sorted(list(st.session_state.topics.keys()))
+    topics = sorted(list(topic_objects.keys()))
     if not topics:
         st.warning("No topics found. You have to generate data first or connect to a database that contains"
                    "pre-generated data!")
@@ -70,20 +107,18 @@ def main():
         if topic != st.session_state.topic_selected:
             print(f"REFETCH TOPIC {topic}")
             st.session_state.topic_selected = topic
-            with Session(engine) as session:
-                tobic_object = session.query(Topic).filter(Topic.name == topic).first()
-                topic_questions = session.query(Question).filter(Question.topic_id == tobic_object.id).order_by(
-                    Question.number).all()
-                st.session_state.questions = {q.name: q for q in topic_questions}
-                st.session_state.question_names = [q.name for q in topic_questions]
-                st.session_state.topic_object = tobic_object
+            tobic_object = topic_objects[topic]
+            topic_questions = load_questions(tobic_object.id)
+            st.session_state.questions = {q.name: q for q in topic_questions}
+            st.session_state.question_names = [q.name for q in topic_questions]
+            st.session_state.topic_object = tobic_object
         tobic_object = st.session_state.topic_object
         st.markdown(tobic_object.description)
 
-        setup_list = sorted([stp.name for stp in st.session_state.setups
+        setup_list = sorted([stp.name for stp in setups
                              if tobic_object.id == stp.topic_id])
         setup_selected = st.selectbox("Choose a setup:", setup_list, index=0, key="setup")
-        setup = [stp for stp in st.session_state.setups
+        setup = [stp for stp in setups
                  if stp.name == setup_selected and tobic_object.id == stp.topic_id][0]
 
         question_name = st.selectbox(
@@ -107,25 +142,20 @@ def main():
                 setup.stats['language_means'].get(str(question.number)).get(x), float) else f"{x} - N/A"
         )
 
-    if st.session_state.question_selected != question or setup_selected != st.session_state.setup_selected:
+    stats_version = stats_versions.get(setup.id)
+    if st.session_state.question_selected != question or setup_selected != st.session_state.setup_selected \
+            or stats_version != st.session_state.stats_version:
 
         print(f"REFETCH ANSWERS FOR QUESTION: {question.name}")
-        with Session(engine) as session:
-            results = session.query(Answer).filter(
-                Answer.topic_id == st.session_state.topic_object.id,
-                Answer.question_id == question.id,
-                Answer.model == setup.model,
-                Answer.answer_english == setup.answer_english,
-                Answer.question_english == setup.question_english,
-                Answer.temperature == setup.temperature,
-                Answer.rating_last == setup.rating_last
-            ).all()
-
-            st.session_state.answers = results
+        st.session_state.answers = load_answers(setup.id, question.id, stats_version)
         if st.session_state.answers:
-            st.session_state.plot = get_plot_cached(st.session_state.answers)
+            if chart_backend == "vega":
+                st.session_state.plot = get_chart_spec(setup, question)
+            else:
+                st.session_state.plot = get_plot_cached(setup, question)
         st.session_state.question_selected = question
         st.session_state.setup_selected = setup_selected
+        st.session_state.stats_version = stats_version
 
     answers = st.session_state.answers
     plot = st.session_state.plot
@@ -136,7 +166,9 @@ def main():
         with col_left:
             st.header(question.description[:150])
             st.markdown(f"<h5>{question_mode(question.mode)}</h5>", unsafe_allow_html=True)
-            if plot:
+            if plot and chart_backend == "vega":
+                st.vega_lite_chart(plot, use_container_width=True)
+            elif plot:
                 st.image(plot)
 
         with col_right:
@@ -220,7 +252,7 @@ def main():
                     col_a_left, col_a_right = st.columns(2)
                     with col_a_left:
                         st.subheader(f"Original Answer {tab_idx + 1} ({answer_translation})")
-                        st.write(answers[tab_idx].answers[language])
+                        st.write(answers[tab_idx].answers.get(language))
                     with col_a_right:
                         st.subheader(f"Translated Answer {tab_idx + 1} ({answer_retranslation})")
                         if answers[tab_idx].translations:
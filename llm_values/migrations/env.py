@@ -0,0 +1,37 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from llm_values.models import Base, get_engine
+
+if context.config.config_file_name:
+    fileConfig(context.config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():
+    context.configure(url=get_engine().url, target_metadata=target_metadata, literal_binds=True,
+                      render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # init_db passes its connection, the alembic CLI connects with DATABASE_URL
+    connection = context.config.attributes.get("connection")
+    if connection is None:
+        with get_engine().connect() as connection:
+            context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=True)
+            with context.begin_transaction():
+                context.run_migrations()
+    else:
+        context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,78 @@
+"""Initial schema (topic, question, answer, setup)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "topic",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("filename", sa.String(), nullable=True),
+        sa.Column("description", sa.String(), nullable=True),
+    )
+    op.create_table(
+        "question",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("number", sa.Integer(), nullable=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=False),
+        sa.Column("mode", sa.String(), nullable=True),
+        sa.Column("question", sa.String(), nullable=False),
+        sa.Column("translations", sa.JSON(), nullable=True),
+        sa.Column("re_translations", sa.JSON(), nullable=True),
+        sa.Column("topic_id", sa.Integer(), sa.ForeignKey("topic.id"), nullable=False),
+    )
+    op.create_table(
+        "answer",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("prompts", sa.JSON(), nullable=True),
+        sa.Column("prefixes", sa.JSON(), nullable=True),
+        sa.Column("formats", sa.JSON(), nullable=True),
+        sa.Column("prefixes_retranslated", sa.JSON(), nullable=True),
+        sa.Column("formats_retranslated", sa.JSON(), nullable=True),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("temperature", sa.Float(), nullable=False),
+        sa.Column("max_tokens", sa.Integer(), nullable=False),
+        sa.Column("rating_last", sa.Boolean(), nullable=False),
+        sa.Column("answer_english", sa.Boolean(), nullable=False),
+        sa.Column("question_english", sa.Boolean(), nullable=False),
+        sa.Column("answers", sa.JSON(), nullable=True),
+        sa.Column("translations", sa.JSON(), nullable=True),
+        sa.Column("ratings", sa.JSON(), nullable=True),
+        sa.Column("stats", sa.JSON(), nullable=True),
+        sa.Column("question_id", sa.Integer(), sa.ForeignKey("question.id"), nullable=False),
+        sa.Column("topic_id", sa.Integer(), sa.ForeignKey("topic.id"), nullable=False),
+    )
+    op.create_index("ix_answer_timestamp", "answer", ["timestamp"])
+    op.create_table(
+        "setup",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("temperature", sa.Float(), nullable=False),
+        sa.Column("rating_last", sa.Boolean(), nullable=False),
+        sa.Column("answer_english", sa.Boolean(), nullable=False),
+        sa.Column("question_english", sa.Boolean(), nullable=False),
+        sa.Column("stats", sa.JSON(), nullable=True),
+        sa.Column("topic_id", sa.Integer(), sa.ForeignKey("topic.id"), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("setup")
+    op.drop_index("ix_answer_timestamp", table_name="answer")
+    op.drop_table("answer")
+    op.drop_table("question")
+    op.drop_table("topic")
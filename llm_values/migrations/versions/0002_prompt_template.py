@@ -0,0 +1,102 @@
+"""Move prefixes / formats of answers into the deduplicated prompt_template table
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+import hashlib
+import json
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+template_columns = ["prefixes", "formats", "prefixes_retranslated", "formats_retranslated"]
+
+answer_table = sa.table(
+    "answer",
+    sa.column("id", sa.Integer),
+    sa.column("prompt_template_id", sa.Integer),
+    *[sa.column(name, sa.JSON) for name in template_columns]
+)
+template_table = sa.Table(
+    "prompt_template",
+    sa.MetaData(),
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("hash", sa.String),
+    *[sa.Column(name, sa.JSON) for name in template_columns]
+)
+
+
+def get_hash(values: list) -> str:
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def upgrade():
+    op.create_table(
+        "prompt_template",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("hash", sa.String(64), nullable=False, unique=True),
+        *[sa.Column(name, sa.JSON(), nullable=True) for name in template_columns]
+    )
+    with op.batch_alter_table("answer") as batch_op:
+        batch_op.add_column(sa.Column("prompt_template_id", sa.Integer(), nullable=True))
+        batch_op.create_foreign_key("fk_answer_prompt_template", "prompt_template", ["prompt_template_id"], ["id"])
+
+    # Fold the (identical) prefixes / formats of all answers into one template each (in chunks of answers)
+    connection = op.get_bind()
+    template_ids = {}
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(answer_table.c.id, *[answer_table.c[name] for name in template_columns])
+            .where(answer_table.c.id > last_id).order_by(answer_table.c.id).limit(1000)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for answer_id, *values in rows:
+            if all(value is None for value in values):
+                continue
+            template_hash = get_hash(values)
+            if template_hash not in template_ids:
+                template_ids[template_hash] = connection.execute(
+                    template_table.insert().values(hash=template_hash, **dict(zip(template_columns, values)))
+                ).inserted_primary_key[0]
+            updates.append({"answer_id": answer_id, "template_id": template_ids[template_hash]})
+
+        if updates:
+            connection.execute(
+                answer_table.update().where(answer_table.c.id == sa.bindparam("answer_id"))
+                .values(prompt_template_id=sa.bindparam("template_id")),
+                updates
+            )
+
+    with op.batch_alter_table("answer") as batch_op:
+        for name in template_columns:
+            batch_op.drop_column(name)
+
+
+def downgrade():
+    with op.batch_alter_table("answer") as batch_op:
+        for name in template_columns:
+            batch_op.add_column(sa.Column(name, sa.JSON(), nullable=True))
+
+    connection = op.get_bind()
+    for template_id, *values in connection.execute(
+            sa.select(template_table.c.id, *[template_table.c[name] for name in template_columns])):
+        connection.execute(
+            answer_table.update().where(answer_table.c.prompt_template_id == template_id)
+            .values(**dict(zip(template_columns, values)))
+        )
+
+    with op.batch_alter_table("answer") as batch_op:
+        batch_op.drop_constraint("fk_answer_prompt_template", type_="foreignkey")
+        batch_op.drop_column("prompt_template_id")
+    op.drop_table("prompt_template")
@@ -0,0 +1,25 @@
+"""Composite index on the setup columns of answers
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_answer_setup",
+        "answer",
+        ["topic_id", "model", "temperature", "rating_last", "answer_english", "question_english", "question_id",
+         "max_tokens"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_answer_setup", table_name="answer")
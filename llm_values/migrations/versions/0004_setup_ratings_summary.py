@@ -0,0 +1,27 @@
+"""Sufficient statistics of setups for incremental stats updates
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("setup") as batch_op:
+        batch_op.add_column(sa.Column("ratings_summary", sa.JSON(), nullable=True))
+        batch_op.add_column(sa.Column("stats_answer_id", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("stats_answer_count", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("setup") as batch_op:
+        batch_op.drop_column("stats_answer_count")
+        batch_op.drop_column("stats_answer_id")
+        batch_op.drop_column("ratings_summary")
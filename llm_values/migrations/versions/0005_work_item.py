@@ -0,0 +1,38 @@
+"""Work item ledger of the LLM calls and repetition number of answers (resumable runs)
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "work_item",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("setup_key", sa.String(), nullable=False),
+        sa.Column("question_id", sa.Integer(), sa.ForeignKey("question.id"), nullable=False),
+        sa.Column("repetition", sa.Integer(), nullable=False),
+        sa.Column("language", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("result", sa.String(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.UniqueConstraint("setup_key", "question_id", "repetition", "language", name="uq_work_item")
+    )
+    with op.batch_alter_table("answer") as batch_op:
+        batch_op.add_column(sa.Column("repetition", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("answer") as batch_op:
+        batch_op.drop_column("repetition")
+    op.drop_table("work_item")
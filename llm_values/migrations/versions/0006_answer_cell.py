@@ -0,0 +1,159 @@
+"""Status and rating of the answers per language (answer_cell)
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+import re
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+answer_table = sa.table(
+    "answer",
+    sa.column("id", sa.Integer),
+    sa.column("answers", sa.JSON),
+    sa.column("ratings", sa.JSON),
+    sa.column("repetition", sa.Integer),
+    *[sa.column(name) for name in ["topic_id", "question_id", "model", "temperature", "max_tokens", "rating_last",
+                                   "answer_english", "question_english"]]
+)
+cell_table = sa.table(
+    "answer_cell",
+    sa.column("answer_id", sa.Integer),
+    sa.column("language", sa.String),
+    sa.column("status", sa.String),
+    sa.column("rating", sa.Integer),
+    sa.column("error", sa.String)
+)
+setup_columns = [answer_table.c[name] for name in [
+    "topic_id", "question_id", "model", "temperature", "max_tokens", "rating_last", "answer_english", "question_english"
+]]
+
+# Prefix of the error messages of failed cells that the downgrade writes back as answer text
+failed_prefix = "Failed call: "
+# Error messages of failed calls that older versions stored as answer text (without a rating)
+error_pattern = re.compile(
+    rf"^({failed_prefix}|\w+(Error|Exception)\b|Error code: \d+|Request timed out|Connection error)"
+)
+
+
+def is_failed(text, rating) -> bool:
+    return rating is None and (not isinstance(text, str) or bool(error_pattern.match(text)))
+
+
+def get_error(text) -> str:
+    return str(text or "No answer").removeprefix(failed_prefix)
+
+
+def get_answer_chunks(connection, *columns, chunk_size: int = 1000):
+    """Rows of the answer table (id first) in chunks, ordered by id"""
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(answer_table.c.id, *columns)
+            .where(answer_table.c.id > last_id).order_by(answer_table.c.id).limit(chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield rows
+
+
+def upgrade():
+    op.create_table(
+        "answer_cell",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("answer_id", sa.Integer(), sa.ForeignKey("answer.id"), nullable=False),
+        sa.Column("language", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("rating", sa.Integer(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.UniqueConstraint("answer_id", "language", name="uq_answer_cell")
+    )
+
+    connection = op.get_bind()
+
+    # Every language of the stored answers is a cell: done, or failed if the answer text is an error message without
+    # a rating (the language is removed from answers and ratings, so that the next run queries it again)
+    for rows in get_answer_chunks(connection, answer_table.c.answers, answer_table.c.ratings):
+        cells = []
+        repaired = []
+        for answer_id, answers, ratings in rows:
+            answers, ratings = dict(answers or {}), dict(ratings or {})
+            failed = [language for language in dict.fromkeys(list(ratings) + list(answers))
+                      if is_failed(answers.get(language), ratings.get(language))]
+            cells += [
+                {"answer_id": answer_id, "language": language, "status": "done", "rating": ratings.get(language),
+                 "error": None}
+                for language in dict.fromkeys(list(ratings) + list(answers)) if language not in failed
+            ]
+            cells += [
+                {"answer_id": answer_id, "language": language, "status": "failed", "rating": None,
+                 "error": get_error(answers.get(language))}
+                for language in failed
+            ]
+            if failed:
+                repaired.append({
+                    "answer_id": answer_id,
+                    "new_answers": {key: value for key, value in answers.items() if key not in failed},
+                    "new_ratings": {key: value for key, value in ratings.items() if key not in failed}
+                })
+        if cells:
+            connection.execute(cell_table.insert(), cells)
+        if repaired:
+            connection.execute(
+                answer_table.update().where(answer_table.c.id == sa.bindparam("answer_id"))
+                .values(answers=sa.bindparam("new_answers"), ratings=sa.bindparam("new_ratings")),
+                repaired
+            )
+
+    # Answers stored before the work ledger get the next free repetitions of their setup and question (in the order of
+    # their ids), so that their failed languages can be repaired like the ones of newer answers
+    next_repetition = {
+        tuple(row[:-1]): row[-1] + 1 for row in connection.execute(
+            sa.select(*setup_columns, sa.func.max(answer_table.c.repetition))
+            .where(answer_table.c.repetition.is_not(None)).group_by(*setup_columns)
+        )
+    }
+    for rows in get_answer_chunks(connection, answer_table.c.repetition, *setup_columns):
+        repetitions = []
+        for answer_id, repetition, *key in rows:
+            if repetition is None:
+                key = tuple(key)
+                repetitions.append({"answer_id": answer_id, "new_repetition": next_repetition.get(key, 0)})
+                next_repetition[key] = repetitions[-1]["new_repetition"] + 1
+        if repetitions:
+            connection.execute(
+                answer_table.update().where(answer_table.c.id == sa.bindparam("answer_id"))
+                .values(repetition=sa.bindparam("new_repetition")),
+                repetitions
+            )
+
+
+def downgrade():
+    # The error messages of failed cells are answer texts again (with failed_prefix, recognized by the upgrade)
+    connection = op.get_bind()
+    errors = {}
+    for answer_id, language, error in connection.execute(
+            sa.select(cell_table.c.answer_id, cell_table.c.language, cell_table.c.error)
+            .where(cell_table.c.status == "failed")
+    ):
+        errors.setdefault(answer_id, {})[language] = f"{failed_prefix}{error}"
+    answer_ids = list(errors)
+    for i in range(0, len(answer_ids), 1000):
+        rows = connection.execute(
+            sa.select(answer_table.c.id, answer_table.c.answers, answer_table.c.ratings)
+            .where(answer_table.c.id.in_(answer_ids[i:i + 1000]))
+        ).fetchall()
+        for answer_id, answers, ratings in rows:
+            connection.execute(answer_table.update().where(answer_table.c.id == answer_id).values(
+                answers={**(answers or {}), **errors[answer_id]},
+                ratings={**(ratings or {}), **{language: None for language in errors[answer_id]}}
+            ))
+    op.drop_table("answer_cell")
@@ -0,0 +1,23 @@
+"""Version counter of the stats of setups (plot and app caches)
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("setup") as batch_op:
+        batch_op.add_column(sa.Column("stats_version", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade():
+    with op.batch_alter_table("setup") as batch_op:
+        batch_op.drop_column("stats_version")
@@ -0,0 +1,52 @@
+"""One answer per repetition of a question and setup
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+key_columns = ["topic_id", "model", "temperature", "rating_last", "answer_english", "question_english", "question_id",
+               "max_tokens"]
+answer_table = sa.table("answer", sa.column("id", sa.Integer), sa.column("repetition", sa.Integer),
+                        *[sa.column(name) for name in key_columns])
+
+
+def upgrade():
+    # Answers stored twice with the same repetition (by an earlier resume) get the next free repetitions
+    connection = op.get_bind()
+    key = [answer_table.c[name] for name in key_columns]
+    rows = connection.execute(
+        sa.select(answer_table.c.id, answer_table.c.repetition, *key)
+        .where(answer_table.c.repetition.is_not(None)).order_by(answer_table.c.id)
+    ).fetchall()
+    used = {}
+    for answer_id, repetition, *setup in rows:
+        used.setdefault(tuple(setup), set()).add(repetition)
+    seen = set()
+    duplicates = []
+    for answer_id, repetition, *setup in rows:
+        setup = tuple(setup)
+        if (setup, repetition) in seen:
+            repetition = max(used[setup]) + 1
+            used[setup].add(repetition)
+            duplicates.append({"answer_id": answer_id, "new_repetition": repetition})
+        seen.add((setup, repetition))
+    if duplicates:
+        connection.execute(
+            answer_table.update().where(answer_table.c.id == sa.bindparam("answer_id"))
+            .values(repetition=sa.bindparam("new_repetition")),
+            duplicates
+        )
+
+    op.create_index("uq_answer_repetition", "answer", key_columns + ["repetition"], unique=True)
+
+
+def downgrade():
+    op.drop_index("uq_answer_repetition", table_name="answer")
@@ -1,10 +1,12 @@
+import hashlib
+import json
 import os
 from datetime import datetime
 from typing import List
 from typing import Optional
 
 from decouple import config
-from sqlalchemy import ForeignKey, String, create_engine, Float, Boolean, JSON, Integer
+from sqlalchemy import event, ForeignKey, String, create_engine, Float, Boolean, JSON, Integer, Index, UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -54,15 +56,48 @@ class Question(Base):
         return f"Question(id={self.id!r}, question={self.question[:100]})"
 
 
-class Answer(Base):
-    __tablename__ = "answer"
+class PromptTemplate(Base):
+    """Translated prefixes and formats of a prompt (shared by all answers of a setup)"""
+    __tablename__ = "prompt_template"
     id: Mapped[int] = mapped_column(primary_key=True)
-    prompts: Mapped[dict] = mapped_column(JSON, nullable=True)
+    hash: Mapped[str] = mapped_column(String(64), unique=True)
     prefixes: Mapped[dict] = mapped_column(JSON, nullable=True)
     formats: Mapped[dict] = mapped_column(JSON, nullable=True)
     prefixes_retranslated: Mapped[dict] = mapped_column(JSON, nullable=True)
     formats_retranslated: Mapped[dict] = mapped_column(JSON, nullable=True)
 
+    answers: Mapped[List["Answer"]] = relationship(back_populates="prompt_template")
+
+    @staticmethod
+    def get_hash(prefixes: dict, formats: dict, prefixes_retranslated: dict, formats_retranslated: dict) -> str:
+        content = json.dumps([prefixes, formats, prefixes_retranslated, formats_retranslated], sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def __repr__(self) -> str:
+        return f"PromptTemplate(id={self.id!r}, hash={self.hash[:8]})"
+
+
+class Answer(Base):
+    __tablename__ = "answer"
+    __table_args__ = (
+        # Setup columns first (stats of a setup), then question (answers of a question), then max_tokens
+        Index(
+            "ix_answer_setup", "topic_id", "model", "temperature", "rating_last", "answer_english",
+            "question_english", "question_id", "max_tokens"
+        ),
+        # One answer per repetition of a question and setup (see WorkLedger)
+        Index(
+            "uq_answer_repetition", "topic_id", "model", "temperature", "rating_last", "answer_english",
+            "question_english", "question_id", "max_tokens", "repetition", unique=True
+        ),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    prompts: Mapped[dict] = mapped_column(JSON, nullable=True)
+
+    # Loaded together with the answers (one query for all templates of the loaded answers)
+    prompt_template_id: Mapped[Optional[int]] = mapped_column(ForeignKey("prompt_template.id"))
+    prompt_template: Mapped[Optional["PromptTemplate"]] = relationship(back_populates="answers", lazy="selectin")
+
     timestamp: Mapped[datetime] = mapped_column(index=True, default=datetime.utcnow)
 
     model: Mapped[str] = mapped_column(String())
@@ -71,6 +106,8 @@ class Answer(Base):
     rating_last: Mapped[bool] = mapped_column(Boolean(), default=False)
     answer_english: Mapped[bool] = mapped_column(Boolean(), default=False)
     question_english: Mapped[bool] = mapped_column(Boolean(), default=False)
+    # Number of the repetition of the question with these settings (its calls are checkpointed as work items)
+    repetition: Mapped[Optional[int]] = mapped_column(Integer())
 
     answers: Mapped[dict] = mapped_column(JSON, nullable=True)
     translations: Mapped[dict] = mapped_column(JSON, nullable=True)
@@ -83,8 +120,108 @@ class Answer(Base):
     topic_id: Mapped[int] = mapped_column(ForeignKey("topic.id"))
     topic: Mapped["Topic"] = relationship(back_populates="answers")
 
+    # Status of the response in every language (answers / ratings only contain the successful languages)
+    cells: Mapped[List["AnswerCell"]] = relationship(back_populates="answer", cascade="all, delete-orphan")
+
+    @classmethod
+    def setup_filter(
+            cls, topic_id: int, model: str, temperature: float, rating_last: bool, answer_english: bool,
+            question_english: bool, question_id: int = None, max_tokens: int = None
+    ) -> list:
+        """Filter conditions for the answers of a setup (optionally of one question), served by ix_answer_setup"""
+        conditions = [
+            cls.topic_id == topic_id,
+            cls.model == model,
+            cls.temperature == temperature,
+            cls.rating_last == rating_last,
+            cls.answer_english == answer_english,
+            cls.question_english == question_english
+        ]
+        if question_id is not None:
+            conditions.append(cls.question_id == question_id)
+        if max_tokens is not None:
+            conditions.append(cls.max_tokens == max_tokens)
+        return conditions
+
+    @property
+    def setup_key(self) -> str:
+        return WorkItem.get_setup_key(
+            self.topic_id, self.model, self.temperature, self.max_tokens, self.rating_last, self.answer_english,
+            self.question_english
+        )
+
+    @property
+    def prefixes(self):
+        return self.prompt_template.prefixes if self.prompt_template else None
+
+    @property
+    def formats(self):
+        return self.prompt_template.formats if self.prompt_template else None
+
+    @property
+    def prefixes_retranslated(self):
+        return self.prompt_template.prefixes_retranslated if self.prompt_template else None
+
+    @property
+    def formats_retranslated(self):
+        return self.prompt_template.formats_retranslated if self.prompt_template else None
+
     def __repr__(self) -> str:
-        return f"Answer(id={self.id!r}, answer={self.answers['English'][:50]} ... {self.answers['English'][-50:]})"
+        return f"Answer(id={self.id!r}, answer={(self.answers or {}).get('English', '')[:50]} ... {(self.answers or {}).get('English', '')[-50:]})"
+
+
+class AnswerCell(Base):
+    """Result of the LLM call of an answer in one language (the response text is stored in Answer.answers)"""
+    __tablename__ = "answer_cell"
+    __table_args__ = (
+        UniqueConstraint("answer_id", "language", name="uq_answer_cell"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    answer_id: Mapped[int] = mapped_column(ForeignKey("answer.id"))
+    answer: Mapped["Answer"] = relationship(back_populates="cells")
+    language: Mapped[str] = mapped_column(String())
+
+    status: Mapped[str] = mapped_column(String(), default="done")  # done or failed
+    rating: Mapped[Optional[int]] = mapped_column(Integer())
+    error: Mapped[Optional[str]] = mapped_column(String())
+
+    def __repr__(self) -> str:
+        return f"AnswerCell(id={self.id!r}, answer_id={self.answer_id}, language={self.language}, status={self.status})"
+
+
+class WorkItem(Base):
+    """LLM call of a run (question x repetition x language with the settings of setup_key) and its result
+
+    The calls of an answer are checkpointed here until the answer is stored, so a crashed run resumes with the calls
+    that are not done yet (see WorkLedger).
+    """
+    __tablename__ = "work_item"
+    __table_args__ = (
+        UniqueConstraint("setup_key", "question_id", "repetition", "language", name="uq_work_item"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    setup_key: Mapped[str] = mapped_column(String())
+    question_id: Mapped[int] = mapped_column(ForeignKey("question.id"))
+    repetition: Mapped[int] = mapped_column(Integer())
+    language: Mapped[str] = mapped_column(String())
+
+    status: Mapped[str] = mapped_column(String(), default="pending")  # pending, in_flight, done or failed
+    attempts: Mapped[int] = mapped_column(Integer(), default=0)
+    result: Mapped[Optional[str]] = mapped_column(String())
+    error: Mapped[Optional[str]] = mapped_column(String())
+    timestamp: Mapped[datetime] = mapped_column(default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @staticmethod
+    def get_setup_key(topic_id: int, model: str, temperature: float, max_tokens: int, rating_last: bool,
+                      answer_english: bool, question_english: bool) -> str:
+        return "|".join(str(value) for value in [
+            topic_id, model, float(temperature), int(max_tokens), bool(rating_last), bool(answer_english),
+            bool(question_english)
+        ])
+
+    def __repr__(self) -> str:
+        return f"WorkItem(id={self.id!r}, question_id={self.question_id}, repetition={self.repetition}, language={self.language}, status={self.status})"
+
 
 class Setup(Base):
     __tablename__ = "setup"
@@ -99,12 +236,59 @@ class Setup(Base):
 
     stats: Mapped[dict] = mapped_column(JSON, nullable=True)
 
+    # Sufficient statistics of the ratings (see RatingsSummary) up to answer stats_answer_id, for incremental updates
+    ratings_summary: Mapped[dict] = mapped_column(JSON, nullable=True)
+    stats_answer_id: Mapped[Optional[int]] = mapped_column(Integer())
+    stats_answer_count: Mapped[Optional[int]] = mapped_column(Integer())
+    # Incremented whenever the stats change (also if repaired answers change ratings, but not the answer ids)
+    stats_version: Mapped[int] = mapped_column(Integer(), default=0, server_default="0")
+
     topic_id: Mapped[int] = mapped_column(ForeignKey("topic.id"))
     topic: Mapped["Topic"] = relationship(back_populates="setups")
 
+    def answer_filter(self, question_id: int = None) -> list:
+        """Filter conditions for the answers of this setup (see Answer.setup_filter)"""
+        return Answer.setup_filter(
+            self.topic_id, self.model, self.temperature, self.rating_last, self.answer_english,
+            self.question_english, question_id=question_id
+        )
+
     def __repr__(self) -> str:
         return f"Setup(id={self.id!r}, model={self.model}, temperature={self.temperature}, rating_last={self.rating_last}, answer_english={self.answer_english}, question_english={self.question_english})"
 
 
-engine = create_engine(config("DATABASE_URL", os.getenv("DATABASE_URL")))
-Base.metadata.create_all(engine)
+_engine = None
+
+
+def get_engine():
+    """Get the database engine (created on first use, the schema is managed by init_db)"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(config("DATABASE_URL", os.getenv("DATABASE_URL")))
+        if _engine.dialect.name == "sqlite":
+            event.listen(_engine, "connect", set_sqlite_pragmas)
+    return _engine
+
+
+def set_sqlite_pragmas(connection, _):
+    # Readers do not block the writer, and commits (one per checkpointed LLM call) do not wait for the disk
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+
+def init_db(revision: str = "head"):
+    """Create / migrate the database schema with the alembic migrations in llm_values/migrations"""
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import inspect
+
+    alembic_config = Config()
+    alembic_config.set_main_option("script_location", os.path.join(os.path.dirname(__file__), "migrations"))
+
+    with get_engine().begin() as connection:
+        alembic_config.attributes["connection"] = connection
+        # Databases created before the migrations (with Base.metadata.create_all) start at the initial revision
+        tables = inspect(connection).get_table_names()
+        if "answer" in tables and "alembic_version" not in tables:
+            command.stamp(alembic_config, "0001")
+        command.upgrade(alembic_config, revision)
@@ -1,39 +1,85 @@
 import argparse
+import gzip
 import json
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, contains_eager
 
-from llm_values.models import engine, Topic, Answer, Question
+from llm_values.models import get_engine, Topic, Answer, Setup
 
 
-def data_to_json(topic: str, filename: str):
+def get_answer_dict(answer: Answer) -> dict:
+    """Answer joined with its question as (JSON-serializable) dict"""
+    answer_dict = answer.dict()
+    # Keep the flat answer format (prefixes and formats are stored once per prompt template)
+    answer_dict.pop("prompt_template", None)
+    answer_dict.pop("cells", None)
+    answer_dict.update({
+        "prefixes": answer.prefixes,
+        "formats": answer.formats,
+        "prefixes_retranslated": answer.prefixes_retranslated,
+        "formats_retranslated": answer.formats_retranslated
+    })
+    answer_dict["question"] = answer.question.dict()
+    return answer_dict
+
+
+def open_output(filename: str):
+    """Open the output file for writing text, compressed with gzip (.gz) or zstandard (.zst)"""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wt", encoding="utf-8")
+    if filename.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is needed for .zst files, install it with: pip install llm_values[export]")
+        return zstandard.open(filename, "wt", encoding="utf-8")
+    return open(filename, "w", encoding="utf-8")
+
+
+def data_to_json(topic: str, filename: str, setup: str = None, chunk_size: int = 1000):
     """Convert data (answers joined with questions) from database to JSON file.
+
+    Files ending with .jsonl (optionally .jsonl.gz / .jsonl.zst) are written as one answer per line while the answers
+    are streamed from the database (constant memory), other files as one indented JSON list.
     :param topic: Name of the topic / dataset to load.
     :param filename: Name of the output json file
+    :param setup: Only export the answers of this setup (name in setups.json)
+    :param chunk_size: Number of answers loaded from the database at once (JSONL)
     """
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         topic_object = session.query(Topic).filter(Topic.name == topic).first()
         if not topic_object:
             topic_object = session.query(Topic).filter(Topic.filename == topic).first()
         if not topic_object:
             raise ValueError(f"Topic '{topic}' not found in database.")
-        answers = session.query(Answer).filter(
-            Answer.topic_id == topic_object.id,
-        ).join(Question).all()
-        answers_json = []
-        for answer in answers:
-            answer_dict = answer.dict()
-            answer_dict["question"] = answer.question.dict()
-            answers_json.append(answer_dict)
 
-        with open(filename, "w") as f:
-            json.dump(answers_json, f, indent=4, default=str)
+        conditions = [Answer.topic_id == topic_object.id]
+        if setup:
+            setup_object = session.query(Setup).filter_by(name=setup, topic_id=topic_object.id).first()
+            if not setup_object:
+                raise ValueError(f"Setup '{setup}' not found for topic '{topic}'.")
+            conditions = setup_object.answer_filter()
+
+        query = (session.query(Answer).filter(*conditions)
+                 .join(Answer.question).options(contains_eager(Answer.question)))
+
+        if ".jsonl" not in filename:
+            answers_json = [get_answer_dict(answer) for answer in query.all()]
+            with open_output(filename) as f:
+                json.dump(answers_json, f, indent=4, default=str)
+            return
+
+        with open_output(filename) as f:
+            for answer in query.order_by(Answer.id).yield_per(chunk_size):
+                f.write(json.dumps(get_answer_dict(answer), ensure_ascii=False, default=str) + "\n")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate questions into multiple languages.")
     parser.add_argument("--topic", default="un_global_issues", help="name of the topic in llm_values/data/resources")
-    parser.add_argument("--filename", default="data.json", help="name of output file")
+    parser.add_argument("--filename", default="data.json",
+                        help="name of output file (.jsonl, .jsonl.gz or .jsonl.zst for streaming JSONL)")
+    parser.add_argument("--setup", default=None, help="only export the answers of this setup in setups.json")
     args = parser.parse_args()
 
-    data_to_json(args.topic, args.filename)
+    data_to_json(args.topic, args.filename, args.setup)
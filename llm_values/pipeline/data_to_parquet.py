@@ -0,0 +1,129 @@
+import argparse
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Topic, Answer, Question, Setup
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is needed for the columnar export, install it with: pip install llm_values[export]")
+    return pyarrow
+
+
+def get_schema():
+    pa = import_pyarrow()
+    category = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("answer_id", pa.int64()),
+        ("question_id", pa.int64()),
+        ("question_number", pa.int32()),
+        ("topic_id", pa.int32()),
+        ("model", category),
+        ("temperature", pa.float32()),
+        ("max_tokens", pa.int32()),
+        ("rating_last", pa.bool_()),
+        ("answer_english", pa.bool_()),
+        ("question_english", pa.bool_()),
+        ("timestamp", pa.timestamp("us")),
+        ("language", category),
+        ("rating", pa.int8()),
+        ("answer", pa.string()),
+        ("translation", pa.string())
+    ])
+
+
+def open_writer(filename: str, schema):
+    """Parquet writer for .parquet files, Arrow IPC file writer (memory-mappable) otherwise (.arrow / .feather)"""
+    pa = import_pyarrow()
+    if filename.endswith(".parquet"):
+        return pa.parquet.ParquetWriter(filename, schema, compression="zstd")
+    return pa.ipc.new_file(filename, schema)
+
+
+def data_to_parquet(topic: str, filename: str, setup: str = None, chunk_size: int = 10000):
+    """Export the answers of a topic in columnar format with one row per answer and language
+
+    The rows contain the rating, answer and translation of the language and the setup columns of the answer,
+    model and language are dictionary-encoded. The answers are streamed from the database in chunks.
+    :param topic: Name of the topic / dataset to load.
+    :param filename: Name of the output file (.parquet, or .arrow / .feather for Arrow IPC)
+    :param setup: Only export the answers of this setup (name in setups.json)
+    :param chunk_size: Number of answers loaded from the database at once
+    """
+    pa = import_pyarrow()
+    schema = get_schema()
+    columns = [
+        Answer.id, Answer.question_id, Question.number, Answer.topic_id, Answer.model, Answer.temperature,
+        Answer.max_tokens, Answer.rating_last, Answer.answer_english, Answer.question_english, Answer.timestamp,
+        Answer.ratings, Answer.answers, Answer.translations
+    ]
+
+    with Session(get_engine()) as session:
+        topic_object = session.query(Topic).filter(Topic.name == topic).first()
+        if not topic_object:
+            topic_object = session.query(Topic).filter(Topic.filename == topic).first()
+        if not topic_object:
+            raise ValueError(f"Topic '{topic}' not found in database.")
+
+        conditions = [Answer.topic_id == topic_object.id]
+        if setup:
+            setup_object = session.query(Setup).filter_by(name=setup, topic_id=topic_object.id).first()
+            if not setup_object:
+                raise ValueError(f"Setup '{setup}' not found for topic '{topic}'.")
+            conditions = setup_object.answer_filter()
+
+        result = session.execute(
+            select(*columns).join(Question, Answer.question_id == Question.id).where(*conditions).order_by(Answer.id),
+            execution_options={"yield_per": chunk_size}
+        )
+        with open_writer(filename, schema) as writer:
+            for rows in result.partitions():
+                chunk = {name: [] for name in schema.names}
+                for *values, ratings, answers, translations in rows:
+                    for language, rating in (ratings or {}).items():
+                        for name, value in zip(schema.names[:11], values):
+                            chunk[name].append(value)
+                        chunk["language"].append(language)
+                        chunk["rating"].append(rating)
+                        chunk["answer"].append((answers or {}).get(language))
+                        chunk["translation"].append((translations or {}).get(language))
+                writer.write_table(pa.Table.from_pydict(chunk, schema=schema))
+
+
+def load_table(filename: str, columns: list[str] = None):
+    """Load an export without copying: Arrow IPC files are memory-mapped, Parquet columns are read with memory map"""
+    pa = import_pyarrow()
+    if filename.endswith(".parquet"):
+        return pa.parquet.read_table(filename, columns=columns, memory_map=True)
+    # The buffers of the table point into the memory map (which stays open as long as the table is used)
+    table = pa.ipc.open_file(pa.memory_map(filename, "r")).read_all()
+    return table.select(columns) if columns else table
+
+
+def table_to_question_ratings(table) -> dict:
+    """Rating dicts of the answers per question number (input of RatingsTensor.from_ratings)"""
+    question_ratings = {}
+    answer_ratings = {}
+    columns = table.select(["answer_id", "question_number", "language", "rating"]).to_pydict()
+    for answer_id, question_number, language, rating in zip(*columns.values()):
+        if answer_id not in answer_ratings:
+            answer_ratings[answer_id] = {}
+            question_ratings.setdefault(question_number, []).append(answer_ratings[answer_id])
+        answer_ratings[answer_id][language] = rating
+    return question_ratings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export answers in columnar format (Parquet / Arrow IPC).")
+    parser.add_argument("--topic", default="un_global_issues", help="name of the topic in llm_values/data/resources")
+    parser.add_argument("--filename", default="data.parquet", help="name of output file (.parquet, .arrow)")
+    parser.add_argument("--setup", default=None, help="only export the answers of this setup in setups.json")
+    args = parser.parse_args()
+
+    data_to_parquet(args.topic, args.filename, args.setup)
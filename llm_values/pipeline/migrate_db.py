@@ -0,0 +1,10 @@
+import argparse
+
+from llm_values.models import init_db
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or migrate the database schema.")
+    parser.add_argument("--revision", default="head", help="alembic revision to migrate to")
+    args = parser.parse_args()
+
+    init_db(args.revision)
@@ -0,0 +1,39 @@
+import argparse
+import os
+
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Setup
+from llm_values.utils.visualize import get_plot_path, render_setup_plot
+
+
+def prerender_plots(setup_name: str = "all", overwrite: bool = False):
+    """Render the plots of all questions of the setups into the plot cache (served by the app)
+
+    :param setup_name: Name of the setup in setups.json ("all" for all setups)
+    :param overwrite: Render the plots again even if they are cached
+    """
+    with Session(get_engine()) as session:
+        if setup_name == "all" or not setup_name:
+            setups = session.query(Setup).all()
+        else:
+            setups = session.query(Setup).filter_by(name=setup_name).all()
+
+        for setup in setups:
+            if not setup.stats:
+                print(f"No stats for setup {setup.name}, run step_4_analyze_results first")
+                continue
+            rendered = 0
+            for question in setup.topic.questions:
+                if overwrite or not os.path.exists(get_plot_path(setup, question)):
+                    rendered += render_setup_plot(setup, question) is not None
+            print(f"Rendered {rendered} plots for setup {setup.name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render the plots of the app for setups.")
+    parser.add_argument("--setup", default="all", help="name of the setup in setups.json (or all)")
+    parser.add_argument("--overwrite", action="store_true", default=False, help="Render cached plots again")
+    args = parser.parse_args()
+
+    prerender_plots(args.setup, args.overwrite)
@@ -1,10 +1,105 @@
 import argparse
 import asyncio
 
+from decouple import config
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Topic
 from llm_values.pipeline.step_0_prepare_prompts import prepare_prompts
-from llm_values.pipeline.step_1_translate_prompts import translate_prompts
-from llm_values.pipeline.step_2_query_llms import query_llms
-from llm_values.pipeline.step_3_translate_answers import translate_answers
+from llm_values.pipeline.step_1_translate_prompts import translate_prompts, translate_all
+from llm_values.pipeline.step_2_query_llms import query_llms, query_answers, prepare_formats
+from llm_values.pipeline.step_3_translate_answers import translate_answers, translate_single
+from llm_values.pipeline.step_4_analyze_results import refresh_setup_stats
+from llm_values.utils.answer_writer import AnswerWriter
+from llm_values.utils.llm_cost import estimate_cost
+from llm_values.utils.pipeline import run_pipeline
+from llm_values.utils.utils import load_json_file
+
+
+async def process_pipelined(
+        topic: str,
+        model: str,
+        num_queries: int = 3,
+        temperature: float = 0,
+        max_tokens: int = 100,
+        rating_last: bool = False,
+        answer_english: bool = False,
+        question_english: bool = False,
+        testing: bool = False,
+        overwrite: bool = False,
+        budget: float = 0.1
+):
+    """Translate, query and translate the answers of every question as soon as the previous step is done for it
+
+    The steps are connected by bounded queues (PIPELINE_QUEUE_SIZE) and run with PIPELINE_WORKERS workers each,
+    so questions are queried while others are still translated. Answers are stored with their translations.
+    """
+    if question_english and answer_english:
+        raise ValueError("Both question and answer cannot be in English")
+
+    languages = load_json_file('languages.json')
+    workers = config("PIPELINE_WORKERS", default=4, cast=int)
+    queue_size = config("PIPELINE_QUEUE_SIZE", default=8, cast=int)
+
+    with Session(get_engine()) as session:
+        topic_object = session.query(Topic).filter(Topic.name == topic).first()
+        if not topic_object:
+            topic_object = session.query(Topic).filter(Topic.filename == topic).first()
+        if not topic_object:
+            raise ValueError(f"Topic '{topic}' not found in database.")
+        questions = topic_object.questions
+
+    if testing:
+        questions = questions[:1]
+        num_queries = 1
+
+    mode_formats = {}
+    for mode in {question.mode for question in questions}:
+        mode_formats[mode] = await prepare_formats(
+            rating_last, question_english, answer_english, max_tokens, languages, mode=mode
+        )
+
+    # Estimate total cost (the questions are not translated yet, their English length is used)
+    estimate_cost([q.question for q in questions], multiplier=2 * len(languages))
+    prefixes, total_formats = mode_formats[questions[0].mode][:2]
+    all_strings = [q.question for q in questions for _ in languages]
+    all_strings += [value for _ in questions for value in list(prefixes.values()) + list(total_formats.values())]
+    estimate_cost(all_strings, multiplier=num_queries, model=model, max_token=max_tokens, budget=budget)
+
+    async def translate_question(question):
+        [question] = await translate_all([question], languages)
+        with Session(get_engine()) as session:
+            session.add(question)
+            session.commit()
+            session.refresh(question)
+        return [question]
+
+    async def query_question(question):
+        print(f"QUESTION {question}")
+        return await query_answers(
+            question, languages, mode_formats[question.mode], topic_id=topic_object.id, model=model,
+            num_queries=num_queries, temperature=temperature, max_tokens=max_tokens, rating_last=rating_last,
+            answer_english=answer_english, question_english=question_english, overwrite=overwrite
+        )
+
+    with AnswerWriter(languages) as writer:
+        async def translate_answer(answer):
+            try:
+                await translate_single(answer)
+            except Exception as e:
+                # Stored without translations, translate_answers translates it later
+                print(f"Translation of answer failed: {e}")
+            writer.add(answer)
+            return []
+
+        await run_pipeline(
+            questions,
+            [(translate_question, workers), (query_question, workers), (translate_answer, workers)],
+            queue_size=queue_size
+        )
+
+    refresh_setup_stats(topic_object.id, model, temperature, rating_last, answer_english, question_english,
+                        full=overwrite or writer.repaired > 0)
 
 
 async def main(
@@ -20,14 +115,24 @@ async def main(
         question_english: bool = False,
         testing: bool = False,
         overwrite: bool = False,
-        budget: float = 0.1
+        budget: float = 0.1,
+        batch: bool = False,
+        pipeline: bool = False
 ):
     await prepare_prompts(topic=topic, description=description, mode=mode)
-    await translate_prompts(topic=topic, testing=testing)
-    await query_llms(topic=topic, num_queries=num_queries, temperature=temperature, max_tokens=max_tokens,
+    if pipeline:
+        if batch:
+            raise ValueError("Batch jobs cannot be pipelined")
+        await process_pipelined(topic=topic, model=model, num_queries=num_queries, temperature=temperature,
+                                max_tokens=max_tokens, rating_last=rating_last, answer_english=answer_english,
+                                question_english=question_english, testing=testing, overwrite=overwrite,
+                                budget=budget)
+        return
+    await translate_prompts(topic=topic, testing=testing, batch=batch)
+    await query_llms(topic=topic, model=model, num_queries=num_queries, temperature=temperature, max_tokens=max_tokens,
                      rating_last=rating_last, answer_english=answer_english, question_english=question_english,
-                     testing=testing, budget=budget)
-    await translate_answers(topic=topic, testing=testing, overwrite=overwrite)
+                     testing=testing, budget=budget, batch=batch)
+    await translate_answers(topic=topic, testing=testing, overwrite=overwrite, batch=batch)
 
 
 if __name__ == "__main__":
@@ -48,6 +153,10 @@ if __name__ == "__main__":
     parser.add_argument("--testing", action="store_true", default=False, help="Run the script in testing mode")
     parser.add_argument("--budget", default=0.1,
                         help="How much you want to spend on LLM calls (get a warning if budget is exceeded)")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Use the batch API (cheaper, but results can take up to 24h)")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="Run the steps for each question as soon as its previous step is done")
     args = parser.parse_args()
 
     asyncio.run(main(**args.__dict__))
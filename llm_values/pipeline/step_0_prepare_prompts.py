@@ -3,7 +3,7 @@ import asyncio
 
 from sqlalchemy.orm import Session
 
-from llm_values.models import engine, Topic, Question
+from llm_values.models import get_engine, init_db, Topic, Question
 from llm_values.utils.prompts import get_prompt
 from llm_values.utils.utils import load_json_file
 
@@ -18,16 +18,20 @@ async def add_questions(items: list[dict[str, str]], topic: str, filename: str,
     :param mode: Mode, one of priorities/values/claims
     """
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
 
         topic_object = session.query(Topic).filter(Topic.name == topic).first()
         if not topic_object:
             topic_object = session.query(Topic).filter(Topic.filename == topic).first()
 
         if not topic_object:
-            topic_object = Topic(name=topic, description=description)
+            topic_object = Topic(name=topic, filename=filename, description=description)
             session.add(topic_object)
             session.commit()
+        elif not topic_object.filename:
+            # Later steps look the topic up by its filename
+            topic_object.filename = filename
+            session.commit()
 
         existing_questions = [itm.name for itm in topic_object.questions]
         max_number = max([q.number for q in topic_object.questions]) if existing_questions else 0
@@ -57,6 +61,8 @@ async def prepare_prompts(topic: str, description: str, mode: str):
     :param mode: Mode, one of priorities/values/claims
     """
 
+    init_db()
+
     topic_json = load_json_file(f"{topic}.json", "resources")
     topic_name = topic_json.get("name", topic)
     filename = topic_json.get("filename", topic)
@@ -3,52 +3,81 @@ import asyncio
 
 from sqlalchemy.orm import Session
 
-from llm_values.models import engine, Topic
-from llm_values.utils.gpt import GPT
+from llm_values.models import get_engine, Topic
 from llm_values.utils.llm_cost import estimate_cost
-from llm_values.utils.translate import translate_task
+from llm_values.utils.translate import translate_batch, get_translation_service
 from llm_values.utils.utils import load_json_file
 
-llm = GPT()
+# Number of items whose translations are requested together (and stored in one transaction)
+translate_batch_size = 100
 
 
-async def translate_all(questions: list, languages: list[str]):
-    tasks = [translate_task(
-        question.question,
-        languages,
-        source="English",
-    ) for question in questions]
-    translated_questions = await asyncio.gather(*tasks)
-
-    for question, translations in zip(questions, translated_questions):
-        question.translations = translations
+async def translate_all(questions: list, languages: list[str], model="gpt-4o-2024-05-13"):
+    """Translate and re-translate questions (all translations of the questions are requested at once)"""
+    service = get_translation_service()
+    keys = [(question.question, "English", language, model) for question in questions for language in languages]
+    translations = await service.translate_many(keys)
+    for question in questions:
+        question.translations = {}
+        for language in languages:
+            translation = translations[(question.question, "English", language, model)]
+            if isinstance(translation, Exception):
+                print(f"Error translating '{question.question}' to {language}: {translation}")
+            else:
+                question.translations[language] = translation
 
     # Re-translations
+    keys = [(question.translations[language], language, "English", model)
+            for question in questions for language in languages if language in question.translations]
+    re_translations = await service.translate_many(keys)
     for question in questions:
-        re_tasks = [translate_task(
-            question.translations[language],
-            languages=["English"],
-            source=language,
-        ) for language in
-            languages]
-        retranslated_questions = await asyncio.gather(*re_tasks)
         question.re_translations = {}
-        for language, retranslation in zip(languages, retranslated_questions):
-            question.re_translations[language] = retranslation["English"]
+        for language in languages:
+            key = (question.translations.get(language), language, "English", model)
+            if key in re_translations and not isinstance(re_translations[key], Exception):
+                question.re_translations[language] = re_translations[key]
 
     return questions
 
 
-async def translate_prompts(topic: str, testing=False):
+async def translate_all_batch(questions: list, languages: list[str], model="gpt-4o-2024-05-13", testing=False):
+    """Translate and re-translate questions with two batch jobs (instead of single chat completions)"""
+    foreign_languages = [language for language in languages if language != "English"]
+
+    keys = [(question.question, "English", language, model) for question in questions for language in foreign_languages]
+    translations = await translate_batch(keys, "translate_prompts", testing=testing)
+    for question in questions:
+        question.translations = {"English": question.question}
+        for language in foreign_languages:
+            if (question.question, "English", language, model) in translations:
+                question.translations[language] = translations[(question.question, "English", language, model)]
+
+    # Re-translations
+    keys = [(question.translations[language], language, "English", model)
+            for question in questions for language in foreign_languages if language in question.translations]
+    re_translations = await translate_batch(keys, "retranslate_prompts", testing=testing)
+    for question in questions:
+        question.re_translations = {"English": question.question}
+        for language in foreign_languages:
+            key = (question.translations.get(language), language, "English", model)
+            if key in re_translations:
+                question.re_translations[language] = re_translations[key]
+
+    return questions
+
+
+async def translate_prompts(topic: str, testing=False, batch=False, budget: float = 0.1):
     """Translate and re-translate prompts into target languages
 
     :param topic: Topic / dataset name
     :param testing: Testing mode (reduced number of questions and models)
+    :param batch: Use the batch API (cheaper, but results can take up to 24h)
+    :param budget: Budget for the translations. Get warning if exceeded
     """
 
     languages = load_json_file('languages.json')
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         topic_object = session.query(Topic).filter(Topic.name == topic).first()
         if not topic_object:
             topic_object = session.query(Topic).filter(Topic.filename == topic).first()
@@ -57,13 +86,21 @@ async def translate_prompts(topic: str, testing=False):
     if testing:
         questions = questions[:1]
 
-    estimate_cost([q.question for q in questions], multiplier=2 * len(languages))
+    estimate_cost([q.question for q in questions], multiplier=2 * len(languages), budget=budget)
+
+    if batch:
+        translated_questions = await translate_all_batch(questions, languages, testing=testing)
+        with Session(get_engine()) as session:
+            for question in translated_questions:
+                session.add(question)
+            session.commit()
+        return
 
-    batches = [questions[i:i + 5] for i in range(0, len(questions), 5)]
-    for j, batch in enumerate(batches):
+    batches = [questions[i:i + translate_batch_size] for i in range(0, len(questions), translate_batch_size)]
+    for j, question_batch in enumerate(batches):
         print(f"Starting batch {j}...")
-        translated_questions = await translate_all(batch, languages)
-        with Session(engine) as session:
+        translated_questions = await translate_all(question_batch, languages)
+        with Session(get_engine()) as session:
             for question in translated_questions:
                 session.add(question)
             session.commit()
@@ -73,6 +110,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate questions into multiple languages.")
     parser.add_argument("--topic", default="un_global_issues", help="name of the topic in llm_values/resources/")
     parser.add_argument("--testing", action="store_true", default=False, help="Run the script in testing mode")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Use the batch API (cheaper, but results can take up to 24h)")
     args = parser.parse_args()
 
-    asyncio.run(translate_prompts(args.topic, testing=args.testing))
+    asyncio.run(translate_prompts(args.topic, testing=args.testing, batch=args.batch))
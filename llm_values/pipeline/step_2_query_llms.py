@@ -1,30 +1,26 @@
 import argparse
 import asyncio
-import os
 
-from joblib import Memory
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
 
-from llm_values.models import engine, Topic, Answer
-from llm_values.pipeline.step_1_translate_prompts import translate_task
-from llm_values.utils.gpt import GPT
+from llm_values.models import get_engine, Topic, Question, Answer, AnswerCell, PromptTemplate
+from llm_values.pipeline.step_4_analyze_results import refresh_setup_stats
+from llm_values.utils.answer_writer import AnswerWriter
+from llm_values.utils.batch import make_batch_request, get_batch_backend, run_batch
+from llm_values.utils.gpt import get_llm
 from llm_values.utils.llm_cost import estimate_cost
+from llm_values.utils.memoize import async_cache
 from llm_values.utils.prompts import get_prefix, get_format_rating, get_format_order, get_language_prompt
 from llm_values.utils.utils import load_json_file
+from llm_values.utils.work_ledger import WorkLedger, DONE, FAILED
 from llm_values.utils.stats import extract_rating
+from llm_values.utils.translate import translate_texts, get_translation_service
 
-cache_dir = ".cache/formats/"
-if not os.path.exists(cache_dir):
-    os.makedirs(cache_dir)
-memory = Memory(cache_dir, verbose=0)
 
-llm = GPT()
-
-
-async def api_call(
-        new_answer, language
-):
-    instruction = new_answer.prefixes[language] + new_answer.formats[language]
+def get_messages(new_answer, language, formats):
+    prefixes, total_formats = formats[0], formats[1]
+    instruction = prefixes[language] + total_formats[language]
     question = new_answer.prompts[language]
     if new_answer.model.startswith("claude"):
         messages = [
@@ -35,44 +31,85 @@ async def api_call(
             {"role": "system", "content": instruction},
             {"role": "user", "content": question}
         ]
+    return messages
 
-    response = llm._create_conversation_completion(
+
+async def api_call(
+        new_answer, language, formats
+):
+    return await get_llm().complete(
         model=new_answer.model,
-        conversation=messages,
+        conversation=get_messages(new_answer, language, formats),
         json_mode=False,
         temperature=float(new_answer.temperature),
         max_tokens=int(new_answer.max_tokens * 1.5)
     )
 
-    if new_answer.model.startswith("claude"):
-        return response.content[0].text
-    else:
-        return response.choices[0].message.content
 
-
-async def api_call_test(
-        **kwargs
-):
-    return "test [[5]]"
+def set_results(answer: Answer, results: dict):
+    """Store the responses (or exceptions of failed calls) per language in the answer and its cells"""
+    cells = {cell.language: cell for cell in answer.cells}
+    answers = dict(answer.answers or {})
+    ratings = dict(answer.ratings or {})
+    for language, result in results.items():
+        if language not in cells:
+            cells[language] = AnswerCell(language=language)
+            answer.cells.append(cells[language])
+        if isinstance(result, Exception):
+            cells[language].status = FAILED
+            cells[language].rating = None
+            cells[language].error = str(result)
+        else:
+            cells[language].status = DONE
+            cells[language].rating = ratings[language] = extract_rating(result)
+            cells[language].error = None
+            answers[language] = result
+    if answer.translations and set(answers) - set(answer.translations):
+        # Translated again with the new languages by translate_answers (the existing translations are cached)
+        answer.translations = None
+    answer.answers = answers
+    answer.ratings = ratings
 
 
 async def query_task(
-        new_answer, languages
+        new_answer, languages, formats
 ):
-    language_tasks = [api_call(new_answer, language) for language in languages]
-    results = await asyncio.gather(*language_tasks, return_exceptions=True)
-    ratings = {}
-    answers = {}
-    for result, language in zip(results, languages):
-        ratings[language] = extract_rating(result)
-        answers[language] = result
-    new_answer.ratings = ratings
-    new_answer.answers = answers
+    """Query the languages of an answer that have no response yet (all for new answers, the failed ones otherwise)"""
+    ledger = WorkLedger.from_answer(new_answer)
+    question_id, repetition = new_answer.question_id, new_answer.repetition
+
+    # Calls that are done since a previous (crashed) run are not repeated
+    results = await ledger.run(ledger.get_results, question_id, repetition)
+    missing_languages = [
+        language for language in languages if language not in results and language not in (new_answer.answers or {})
+    ]
+    await ledger.run(ledger.start, question_id, repetition, missing_languages)
+
+    async def checkpointed_call(language):
+        try:
+            result = await api_call(new_answer, language, formats)
+        except Exception as e:
+            await ledger.run(ledger.failed, question_id, repetition, language, e)
+            raise
+        await ledger.run(ledger.done, question_id, repetition, language, result)
+        return result
+
+    language_tasks = [checkpointed_call(language) for language in missing_languages]
+    results.update(zip(missing_languages, await asyncio.gather(*language_tasks, return_exceptions=True)))
+    failed = [language for language in missing_languages if isinstance(results[language], Exception)]
+    if failed and len(failed) == len(missing_languages):
+        if new_answer.id is not None:
+            # The failed cells of a stored answer are repaired again in the next run (registered by prepare_answers)
+            await ledger.run(ledger.remove, question_id, repetition)
+        # The retries of the llm client are exhausted (or the error is permanent)
+        raise Exception(f"Query failed for languages {failed}: {results[failed[0]]}")
+    # The other languages are stored, the failed ones are queried again in the next run
+    set_results(new_answer, {language: results[language] for language in languages if language in results})
 
     return new_answer
 
 
-@memory.cache
+@async_cache(".cache/formats/")
 async def prepare_formats(
         rating_last: bool, question_english: bool, answer_english: bool, max_tokens: int, languages: list[str], mode: str
 ) -> tuple[dict[str, str], ...]:
@@ -83,7 +120,7 @@ async def prepare_formats(
     :param max_tokens: Max token of response
     :param languages: List of target languages
     :param mode: Mode of the topic, one of priorities/values/claims
-    :return: Translated prefixes and formats
+    :return: Translated prefixes and formats (computed once and cached in .cache/formats/)
     """
 
     prefix_english = get_prefix()
@@ -101,31 +138,249 @@ async def prepare_formats(
         prefixes_retranslated = {language: "" for language in languages}
         formats_retranslated = {language: "" for language in languages}
     else:
-        prefix_task = translate_task(prefix_english, languages, source="English", model="gpt-4o-2024-05-13")
-        rating_format_task = translate_task(rating_format_english, languages, source="English",
-                                            model="gpt-4o-2024-05-13")
-        order_format_task = translate_task(order_format_english, languages, source="English",
-                                           model="gpt-4o-2024-05-13")
-        language_format_task = translate_task(language_format_english, languages, source="English",
-                                              model="gpt-4o-2024-05-13")
-        [prefixes, rating_formats, order_formats, language_formats] = await asyncio.gather(
-            prefix_task, rating_format_task, order_format_task, language_format_task)
+        model = "gpt-4o-2024-05-13"
+        [prefixes, rating_formats, order_formats, language_formats] = await translate_texts(
+            [prefix_english, rating_format_english, order_format_english, language_format_english], languages,
+            source="English", model=model
+        )
 
         total_formats = {language: rating_formats[language] + order_formats[language] + language_formats[language]
                          for language in languages}
 
-        prefixes_retranslated_tasks = [translate_task(prefix, ["English"], source=lang, model="gpt-4o-2024-05-13")
-                                       for lang, prefix in prefixes.items()]
-        prefixes_retranslated = {lang: result["English"]
-                                 for lang, result in zip(languages, await asyncio.gather(*prefixes_retranslated_tasks))}
-        formats_retranslated_tasks = [translate_task(form, ["English"], source=lang, model="gpt-4o-2024-05-13")
-                                      for lang, form in total_formats.items()]
-        formats_retranslated = {lang: result["English"]
-                                for lang, result in zip(languages, await asyncio.gather(*formats_retranslated_tasks))}
+        # Back-translations of prefixes and formats (requested together, the shared ones are translated once)
+        back_translations = await get_translation_service().translate_many(
+            [(text, language, "English", model) for texts in [prefixes, total_formats]
+             for language, text in texts.items()]
+        )
+        errors = [result for result in back_translations.values() if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        prefixes_retranslated = {language: back_translations[(prefix, language, "English", model)]
+                                 for language, prefix in prefixes.items()}
+        formats_retranslated = {language: back_translations[(form, language, "English", model)]
+                                for language, form in total_formats.items()}
 
     return prefixes, total_formats, prefixes_retranslated, formats_retranslated
 
 
+def get_prompt_template_id(formats: tuple[dict[str, str], ...]) -> int:
+    """Get the id of the prompt template with the given prefixes and formats (created if it does not exist yet)"""
+    prefixes, total_formats, prefixes_retranslated, formats_retranslated = formats
+    template_hash = PromptTemplate.get_hash(prefixes, total_formats, prefixes_retranslated, formats_retranslated)
+
+    with Session(get_engine()) as session:
+        template = session.query(PromptTemplate).filter(PromptTemplate.hash == template_hash).first()
+        if template:
+            return template.id
+        try:
+            template = PromptTemplate(
+                hash=template_hash,
+                prefixes=prefixes,
+                formats=total_formats,
+                prefixes_retranslated=prefixes_retranslated,
+                formats_retranslated=formats_retranslated
+            )
+            session.add(template)
+            session.commit()
+            return template.id
+        except IntegrityError:
+            # Created concurrently by another process
+            session.rollback()
+            return session.query(PromptTemplate).filter(PromptTemplate.hash == template_hash).one().id
+
+
+def prepare_answers(
+        question: Question,
+        topic_id: int,
+        languages: list[str],
+        formats: tuple[dict[str, str], ...],
+        model: str,
+        num_queries: int,
+        temperature: float,
+        max_tokens: int,
+        rating_last: bool,
+        answer_english: bool,
+        question_english: bool,
+        overwrite: bool = False
+) -> list[Answer]:
+    """Create the (not yet queried) answers that are missing for a question, together with the stored answers of the
+    question with failed languages (only these languages are queried again)
+
+    :param question: Question object (with translations)
+    :param topic_id: Id of the topic of the question
+    :param languages: List of target languages
+    :param formats: Prefixes, formats and their re-translations (see prepare_formats)
+    """
+    prompt_template_id = get_prompt_template_id(formats)
+    ledger = WorkLedger(topic_id, model, temperature, max_tokens, rating_last, answer_english, question_english)
+
+    with Session(get_engine()) as session:
+        # Check if answers already exists
+        answers = session.query(Answer).options(selectinload(Answer.cells)).filter(*Answer.setup_filter(
+            topic_id, model, temperature, rating_last, answer_english, question_english,
+            question_id=question.id, max_tokens=max_tokens
+        )).all()
+
+        if answers and overwrite:
+            for answer in answers:
+                session.delete(answer)
+            session.commit()
+            answers = []
+    if overwrite:
+        ledger.clear(question.id)
+
+    repaired_answers = [
+        answer for answer in answers
+        if answer.repetition is not None and any(cell.status == FAILED for cell in answer.cells)
+    ]
+
+    # Unfinished repetitions of a previous run are resumed (see WorkLedger)
+    repetitions = ledger.get_repetitions(question.id, num_queries - len(answers))
+    ledger.add(question.id, repetitions, languages)
+    # Repaired answers only query their failed languages
+    for answer in repaired_answers:
+        ledger.add(question.id, [answer.repetition],
+                   [cell.language for cell in answer.cells if cell.status == FAILED])
+
+    new_answers = []
+    for repetition in repetitions:
+        if question_english:
+            prompts = {language: question.translations["English"] for language in languages}
+        else:
+            prompts = question.translations
+
+        new_answers.append(Answer(
+            prompts=prompts,
+            prompt_template_id=prompt_template_id,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            rating_last=rating_last,
+            answer_english=answer_english,
+            question_english=question_english,
+            repetition=repetition,
+            question_id=question.id,
+            topic_id=topic_id
+        ))
+
+    return new_answers + repaired_answers
+
+
+async def query_answers(
+        question: Question, languages: list[str], formats: tuple[dict[str, str], ...], **kwargs
+) -> list[Answer]:
+    """Query the LLM (num_queries times in all languages) for a single question
+
+    :param question: Question object (with translations)
+    :param languages: List of target languages
+    :param formats: Prefixes, formats and their re-translations (see prepare_formats)
+    :param kwargs: Further arguments of prepare_answers
+    :return: The new and repaired (not yet stored) answers
+    """
+    new_answers = await WorkLedger.run(prepare_answers, question, languages=languages, formats=formats, **kwargs)
+    query_tasks = [query_task(new_answer, languages, formats) for new_answer in new_answers]
+    results = await asyncio.gather(*query_tasks, return_exceptions=True)
+
+    # Keep the successful repetitions, missing ones are queried again in the next run
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Skipping answer for question {question.id}: {result}")
+    return [result for result in results if not isinstance(result, Exception)]
+
+
+async def query_question(
+        question: Question, languages: list[str], formats: tuple[dict[str, str], ...], writer: AnswerWriter, **kwargs
+):
+    """Query the LLM (num_queries times in all languages) for a single question and store the answers
+
+    :param question: Question object (with translations)
+    :param languages: List of target languages
+    :param formats: Prefixes, formats and their re-translations (see prepare_formats)
+    :param writer: Buffered writer that stores the answers
+    :param kwargs: Further arguments of prepare_answers
+    """
+    print(f"QUESTION {question}")
+
+    try:
+        for answer in await query_answers(question, languages, formats, **kwargs):
+            writer.add(answer)
+    except Exception as e:
+        print(e)
+
+
+async def query_batch(new_answers: list[tuple[Answer, tuple]], languages: list[str], writer: AnswerWriter,
+                      testing: bool = False):
+    """Query all answers (in all languages without response) with one batch job and store the answers
+
+    :param new_answers: List of (answer, prefixes and formats of the answer)
+    :param languages: List of target languages
+    :param writer: Buffered writer that stores the answers
+    :param testing: Testing mode (test batch backend, no LLM calls)
+    """
+    backend = get_batch_backend(new_answers[0][0].model, testing=testing)
+    ledger = WorkLedger.from_answer(new_answers[0][0])
+
+    # Calls that are done since a previous (crashed) run are not sent again, stored answers only query failed languages
+    results = await ledger.run(lambda: [
+        ledger.get_results(new_answer.question_id, new_answer.repetition) for new_answer, _ in new_answers
+    ])
+    missing_languages = []
+    requests = []
+    for j, (new_answer, formats) in enumerate(new_answers):
+        missing_languages.append([
+            language for language in languages
+            if language not in results[j] and language not in (new_answer.answers or {})
+        ])
+        requests += [
+            make_batch_request(
+                f"{j}|{language}",
+                new_answer.model,
+                get_messages(new_answer, language, formats),
+                temperature=float(new_answer.temperature),
+                max_tokens=int(new_answer.max_tokens * 1.5)
+            )
+            for language in missing_languages[j]
+        ]
+
+    # The checkpoints of all answers are written in the ledger thread at once (before and after the batch job)
+    def start_calls():
+        for j, (new_answer, _) in enumerate(new_answers):
+            ledger.start(new_answer.question_id, new_answer.repetition, missing_languages[j])
+
+    def checkpoint_results():
+        for j, (new_answer, _) in enumerate(new_answers):
+            for language in missing_languages[j]:
+                if isinstance(results[j][language], Exception):
+                    ledger.failed(new_answer.question_id, new_answer.repetition, language, results[j][language])
+                else:
+                    ledger.done(new_answer.question_id, new_answer.repetition, language, results[j][language])
+
+    await ledger.run(start_calls)
+    texts = await run_batch(requests, "query_llms", backend) if requests else {}
+
+    for j, (new_answer, _) in enumerate(new_answers):
+        for language in missing_languages[j]:
+            results[j][language] = texts.get(f"{j}|{language}", Exception("No result in batch job"))
+    await ledger.run(checkpoint_results)
+
+    failed_repairs = []
+    for j, (new_answer, _) in enumerate(new_answers):
+        # Answers without any new response are skipped and queried again in the next run
+        if missing_languages[j] and all(isinstance(results[j][language], Exception) for language in missing_languages[j]):
+            if new_answer.id is not None:
+                failed_repairs.append(new_answer)
+            continue
+        set_results(new_answer, results[j])
+        writer.add(new_answer)
+
+    # The failed cells of stored answers are repaired again in the next run (registered by prepare_answers)
+    def remove_failed_repairs():
+        for answer in failed_repairs:
+            ledger.remove(answer.question_id, answer.repetition)
+
+    await ledger.run(remove_failed_repairs)
+
+
 async def query_llms(
         topic: str,
         model: str,
@@ -137,7 +392,8 @@ async def query_llms(
         question_english: bool = False,
         testing: bool = False,
         overwrite: bool = False,
-        budget: float = 0.1
+        budget: float = 0.1,
+        batch: bool = False
 ):
     """Query LLMs for answers to questions for different languages + models and given settings
 
@@ -152,13 +408,14 @@ async def query_llms(
     :param testing: Testing mode (reduced number of questions and models)
     :param overwrite: Whether to overwrite previous answers (otherwise skip existing answers)
     :param budget: Budget for LLM calls. Get warning if exceeded
+    :param batch: Use the batch API (cheaper, but results can take up to 24h)
     """
     if question_english and answer_english:
         raise ValueError("Both question and answer cannot be in English")
 
     languages = load_json_file('languages.json')  # assuming models are stored in a list
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # Load questions and existing answers
         topic_object = session.query(Topic).filter(Topic.name == topic).first()
         if not topic_object:
@@ -173,10 +430,15 @@ async def query_llms(
         questions = questions[:1]
         num_queries = 1
 
+    # Prepare option-dependent prefix and format (once per mode, before the questions run concurrently)
+    mode_formats = {}
+    for mode in {question.mode for question in questions}:
+        mode_formats[mode] = await prepare_formats(
+            rating_last, question_english, answer_english, max_tokens, languages, mode=mode
+        )
+
     # Estimate total query cost
-    prefixes, total_formats, prefixes_retranslated, formats_retranslated = await prepare_formats(
-        rating_last, question_english, answer_english, max_tokens, languages, mode=questions[0].mode
-    )
+    prefixes, total_formats, prefixes_retranslated, formats_retranslated = mode_formats[questions[0].mode]
     all_strings = [value for q in questions for key, value in q.translations.items()]
     all_strings += [value for _ in questions for key, value in prefixes.items()]
     all_strings += [value for _ in questions for key, value in total_formats.items()]
@@ -188,72 +450,39 @@ async def query_llms(
         budget=budget
     )
 
-    # Loop each question
-    for j, question in enumerate(questions):
-        print(f"QUESTION {question}")
-
-        # Prepare option-dependent prefix and format
-        prefixes, total_formats, prefixes_retranslated, formats_retranslated = await prepare_formats(
-            rating_last, question_english, answer_english, max_tokens, languages, mode=question.mode
-        )
-        with Session(engine) as session:
-            # Check if answers already exists
-            answers = session.query(Answer).filter(
-                Answer.topic_id == topic_object.id,
-                Answer.question_id == question.id,
-                Answer.model == model,
-                Answer.temperature == temperature,
-                Answer.max_tokens == max_tokens,
-                Answer.rating_last == rating_last,
-                Answer.answer_english == answer_english,
-                Answer.question_english == question_english
-            ).all()
-
-            if answers and overwrite:
-                for answer in answers:
-                    session.delete(answer)
-                session.commit()
-
-        num_queries_now = num_queries - len(answers)
-        if num_queries_now <= 0:
-            continue
+    writer = AnswerWriter(languages)
+    if batch:
+        new_answers = []
+        for question in questions:
+            new_answers += [(new_answer, mode_formats[question.mode]) for new_answer in await WorkLedger.run(
+                prepare_answers, question, topic_object.id, languages, mode_formats[question.mode], model, num_queries,
+                temperature, max_tokens, rating_last, answer_english, question_english, overwrite
+            )]
+        if new_answers:
+            with writer:
+                await query_batch(new_answers, languages, writer, testing=testing)
+    else:
+        # Query all questions concurrently (number of parallel calls is bounded by LLM_MAX_CONCURRENCY)
+        with writer:
+            question_tasks = [
+                query_question(question, languages, topic_id=topic_object.id, formats=mode_formats[question.mode],
+                               writer=writer, model=model, num_queries=num_queries, temperature=temperature,
+                               max_tokens=max_tokens, rating_last=rating_last, answer_english=answer_english,
+                               question_english=question_english, overwrite=overwrite)
+                for question in questions
+            ]
+            await asyncio.gather(*question_tasks)
+
+    unfinished = WorkLedger(topic_object.id, model, temperature, max_tokens, rating_last, answer_english,
+                            question_english).get_status_counts()
+    if unfinished:
+        print(f"Unfinished LLM calls (resumed in the next run): {unfinished}")
+
+    # Add the new answers to the stats of the matching setups (overwritten and repaired answers need a full
+    # recalculation)
+    refresh_setup_stats(topic_object.id, model, temperature, rating_last, answer_english, question_english,
+                        full=overwrite or writer.repaired > 0)
 
-        try:
-            # Loop each iteration
-            query_tasks = []
-            for _ in range(num_queries_now):
-                if question_english:
-                    prompts = {language: question.translations["English"] for language in languages}
-                else:
-                    prompts = question.translations
-
-                new_answer = Answer(
-                    prompts=prompts,
-                    prefixes=prefixes,
-                    formats=total_formats,
-                    prefixes_retranslated=prefixes_retranslated,
-                    formats_retranslated=formats_retranslated,
-                    model=model,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    rating_last=rating_last,
-                    answer_english=answer_english,
-                    question_english=question_english,
-                    question_id=question.id,
-                    topic_id=topic_object.id
-                )
-
-                query_tasks.append(query_task(new_answer, languages))
-
-            results = await asyncio.gather(*query_tasks, return_exceptions=True)
-
-            with Session(engine) as session:
-                for result in results:
-                    session.add(result)
-                    session.commit()
-        except Exception as e:
-            print(e)
-            continue
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Query LLM with translated questions.")
@@ -272,6 +501,8 @@ if __name__ == "__main__":
     parser.add_argument("--testing", action="store_true", default=False, help="Run the script in testing mode")
     parser.add_argument("--budget", default=0.1,
                         help="How much you want to spend on LLM calls (get a warning if budget is exceeded)")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Use the batch API (cheaper, but results can take up to 24h)")
     args = parser.parse_args()
     args_dict = args.__dict__
 
@@ -3,44 +3,74 @@ import asyncio
 
 from sqlalchemy.orm import Session
 
-from llm_values.models import engine, Topic, Answer
-from llm_values.utils.gpt import GPT
+from llm_values.models import get_engine, Topic, Answer
 from llm_values.utils.llm_cost import estimate_cost
-from llm_values.utils.translate import translate_task
+from llm_values.utils.translate import translate_batch, get_translation_service
 
-llm = GPT()
+# Number of items whose translations are requested together (and stored in one transaction)
+translate_batch_size = 100
 
 
-async def translate_single(answer: Answer):
-    languages = list(answer.answers.keys())
-    re_tasks = []
-    for language in languages:
+def get_translation_keys(answer: Answer, model="gpt-4o-2024-05-13") -> dict:
+    """Translation request of the answer in every language (to English, or to the language if answered in English)"""
+    keys = {}
+    for language, text in answer.answers.items():
         s_language = "English" if answer.answer_english else language
         t_language = language if answer.answer_english else "English"
-        re_tasks.append(translate_task(answer.answers.get(language), [t_language], source=s_language))
+        keys[language] = (text, s_language, t_language, model)
+    return keys
+
+
+async def translate_all(answers: list[Answer]):
+    """Translate the answers (the translations of all answers are requested at once, identical texts once)
+
+    Answers with a failed translation keep their translations and are translated again in the next run.
+    """
+    answer_keys = [get_translation_keys(answer) for answer in answers]
+    translations = await get_translation_service().translate_many(
+        [key for keys in answer_keys for key in keys.values()]
+    )
+    for answer, keys in zip(answers, answer_keys):
+        if any(isinstance(translations[key], Exception) for key in keys.values()):
+            print(f"Translation of answer {answer.id} failed")
+            continue
+        answer.translations = {language: translations[key] for language, key in keys.items()}
+    return answers
+
 
-    translated_answers = await asyncio.gather(*re_tasks, return_exceptions=True)
-    answer.translations = {lang: trans[lang] if answer.answer_english else trans["English"]
-                           for lang, trans in zip(languages, translated_answers)}
+async def translate_single(answer: Answer):
+    [answer] = await translate_all([answer])
     return answer
 
 
-async def translate_all(answers: list[Answer]):
-    translate_tasks = [translate_single(answer) for answer in answers]
-    answers = await asyncio.gather(*translate_tasks, return_exceptions=True)
+async def translate_all_batch(answers: list[Answer], model="gpt-4o-2024-05-13", testing=False):
+    """Translate all answers with one batch job (instead of single chat completions)"""
+    answer_keys = {answer.id: get_translation_keys(answer, model) for answer in answers}
+
+    # Translation to the same language is the answer itself (like in translate_task)
+    translations = await translate_batch(
+        [key for keys in answer_keys.values() for key in keys.values() if key[1] != key[2]], "translate_answers",
+        testing=testing
+    )
+    for answer in answers:
+        keys = answer_keys[answer.id]
+        if all(key in translations or key[1] == key[2] for key in keys.values()):
+            answer.translations = {language: translations.get(key, key[0]) for language, key in keys.items()}
     return answers
 
 
-async def translate_answers(topic: str, testing=False, overwrite=False):
+async def translate_answers(topic: str, testing=False, overwrite=False, batch=False, budget: float = 0.1):
     """Translate answers back to English (or target language, if answer is given in English)
 
     :param topic: Topic / dataset name
     :param testing: Testing mode (reduced number of questions and models)
     :param overwrite: Whether to re-translate answers or keep existing translations
+    :param batch: Use the batch API (cheaper, but results can take up to 24h)
+    :param budget: Budget for the translations. Get warning if exceeded
     """
 
     # Load answers
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         topic_object = session.query(Topic).filter(Topic.name == topic).first()
         if not topic_object:
             topic_object = session.query(Topic).filter(Topic.filename == topic).first()
@@ -52,13 +82,21 @@ async def translate_answers(topic: str, testing=False, overwrite=False):
     if testing:
         answers = answers[:1]
 
-    estimate_cost([value for q in answers for key, value in q.answers.items()])
+    estimate_cost([value for q in answers for key, value in q.answers.items()], budget=budget)
+
+    if batch:
+        translated_answers = await translate_all_batch(answers, testing=testing)
+        with Session(get_engine()) as session:
+            for ans in translated_answers:
+                session.add(ans)
+            session.commit()
+        return
 
-    batches = [answers[i:i + 5] for i in range(0, len(answers), 5)]
-    for j, batch in enumerate(batches):
+    batches = [answers[i:i + translate_batch_size] for i in range(0, len(answers), translate_batch_size)]
+    for j, answer_batch in enumerate(batches):
         print(f"Starting batch {j}...")
-        translated_answers = await translate_all(batch)
-        with Session(engine) as session:
+        translated_answers = await translate_all(answer_batch)
+        with Session(get_engine()) as session:
             for ans in translated_answers:
                 session.add(ans)
             session.commit()
@@ -68,6 +106,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate answer back to English.")
     parser.add_argument("--topic", default="un_global_issues", help="name of the topic in llm_values/resources/")
     parser.add_argument("--testing", action="store_true", default=False, help="Run the script in testing mode")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Use the batch API (cheaper, but results can take up to 24h)")
     args = parser.parse_args()
 
-    asyncio.run(translate_answers(args.topic, testing=args.testing))
+    asyncio.run(translate_answers(args.topic, testing=args.testing, batch=args.batch))
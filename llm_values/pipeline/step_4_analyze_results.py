@@ -1,21 +1,26 @@
 import argparse
 import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 
+from sqlalchemy import select, func
 from sqlalchemy.orm import Session
 from sqlalchemy.orm.attributes import flag_modified
 
-from llm_values.models import engine, Topic, Answer, Setup
-from llm_values.utils.stats import get_question_discrepancy, get_cleaned_question_discrepancy, \
-    get_average, get_language_failure_rate, get_language_refusal_rate, get_language_assertiveness, \
-    get_cleaned_language_assertiveness, get_refusal_rates, get_failure_rates, get_question_assertiveness, \
-    get_language_means, get_language_std
+from llm_values.models import get_engine, Topic, Answer, AnswerCell, Setup
+from llm_values.pipeline.prerender_plots import prerender_plots
+from llm_values.utils.stats import RatingsTensor, RatingsSummary
 from llm_values.utils.utils import load_json_file
+from llm_values.utils.work_ledger import DONE
 
 
 def add_setups():
     all_setups = load_json_file("setups.json", "data")
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
 
         topics = session.query(Topic).all()
 
@@ -36,81 +41,155 @@ def add_setups():
                     print(f"Added setup {setup} for topic {topic_object.name}")
 
 
-async def calc_stats(topic_object, params: dict):
-    all_stats = {}
-    with Session(engine) as session:
-        # Load answers
-        questions = topic_object.questions
-        results = session.query(Answer).filter_by(**params).all()
-
-        try:
-            question_discrepancies = {}
-            question_cleaned_discrepancies = {}
-            question_assertivenesses = {}
-            question_refusal_rates = {}
-            question_failure_rates = {}
-            question_language_means = {}
-            question_language_std = {}
-            for question in questions:
-                aggregated_answers = [answer for answer in results if answer.question_id == question.id]
-                question_language_means[question.number] = get_language_means(aggregated_answers)
-                question_language_std[question.number] = get_language_std(aggregated_answers)
-                question_discrepancies[question.number] = get_question_discrepancy(aggregated_answers)
-                question_cleaned_discrepancies[question.number] = get_cleaned_question_discrepancy(aggregated_answers)
-                question_assertivenesses[question.number] = get_question_assertiveness(aggregated_answers)
-                question_refusal_rates[question.number] = get_refusal_rates(aggregated_answers)
-                question_failure_rates[question.number] = get_failure_rates(aggregated_answers)
-
-            all_stats["discrepancies"] = question_discrepancies
-            all_stats["cleaned_discrepancies"] = question_cleaned_discrepancies
-            all_stats["assertivenesses"] = question_assertivenesses
-            all_stats["refusal_rates"] = question_refusal_rates
-            all_stats["failure_rates"] = question_failure_rates
-
-            all_stats["dataset_discrepancy"] = get_average(question_discrepancies)
-            all_stats["cleaned_dataset_discrepancy"] = get_average(question_cleaned_discrepancies)
-            all_stats["dataset_assertiveness"] = get_average(question_assertivenesses)
-            all_stats["refusal_rate"] = get_average(question_refusal_rates)
-            all_stats["failure_rate"] = get_average(question_failure_rates)
-
-            all_stats["language_means"] = question_language_means
-            all_stats["language_std"] = question_language_std
-            all_stats["language_refusal_rate"] = get_language_refusal_rate(results)
-            all_stats["language_failure_rate"] = get_language_failure_rate(results)
-            all_stats["language_assertiveness"] = get_language_assertiveness(results)
-            all_stats["cleaned_language_assertiveness"] = get_cleaned_language_assertiveness(results)
-
-        except Exception as e:
-            print(e)
-    return all_stats
-
-
-async def analyze_results(setup_name: str):
+def get_question_ratings(session: Session, topic_object, conditions: list, after_id: int = 0,
+                         until_id: int = None) -> dict:
+    """Load the ratings of the answers matching the conditions (see Answer.setup_filter), grouped by question number
+
+    Only the ratings of the successful languages (done answer cells) are fetched, ordered by question and answer, and
+    grouped in one pass.
+    :param after_id: Only answers with a larger id (answers added after the last stats update)
+    :param until_id: Only answers up to this id
+    """
+    question_numbers = {question.id: question.number for question in topic_object.questions}
+    conditions = conditions + [Answer.id > after_id, AnswerCell.status == DONE]
+    if until_id is not None:
+        conditions.append(Answer.id <= until_id)
+    rows = session.execute(
+        select(Answer.question_id, AnswerCell.answer_id, AnswerCell.language, AnswerCell.rating)
+        .join(AnswerCell, AnswerCell.answer_id == Answer.id)
+        .where(*conditions)
+        .order_by(Answer.question_id, AnswerCell.answer_id, AnswerCell.id)
+    )
+    return {
+        question_numbers[question_id]: [
+            {language: rating for _, _, language, rating in cells}
+            for _, cells in groupby(question_rows, key=itemgetter(1))
+        ]
+        for question_id, question_rows in groupby(rows, key=itemgetter(0))
+    }
+
+
+def update_setup_stats(session: Session, setup: Setup, topic_object, full: bool = False) -> bool:
+    """Update the stats of a setup with the answers added since the last update
+
+    The sufficient statistics of the setup (Setup.ratings_summary) are kept together with the id of the last
+    included answer and the number of included answers. If answers were deleted in the meantime (e.g. overwritten),
+    the counts do not add up and the stats are recalculated from all answers.
+    :param full: Always recalculate from all answers
+    :return: If the stats were changed
+    """
+    conditions = setup.answer_filter()
+    count, last_id = session.execute(select(func.count(Answer.id), func.max(Answer.id)).where(*conditions)).one()
+    last_id = last_id or 0
+
+    summary = None
+    if not full and setup.ratings_summary is not None and setup.stats_answer_id is not None:
+        if setup.stats_answer_id == last_id and setup.stats_answer_count == count:
+            return False
+        new_ratings = get_question_ratings(session, topic_object, conditions, setup.stats_answer_id, last_id)
+        if setup.stats_answer_count + sum(len(ratings) for ratings in new_ratings.values()) == count:
+            summary = RatingsSummary.from_dict(setup.ratings_summary)
+            if new_ratings:
+                summary = summary.merge(RatingsTensor.from_ratings(new_ratings).summary())
+    if summary is None:
+        ratings = get_question_ratings(session, topic_object, conditions, until_id=last_id)
+        summary = RatingsTensor.from_ratings(ratings).summary()
+
+    setup.ratings_summary = summary.to_dict()
+    setup.stats = summary.get_stats()
+    setup.stats_answer_id = last_id
+    setup.stats_answer_count = count
+    setup.stats_version = (setup.stats_version or 0) + 1
+    flag_modified(setup, "ratings_summary")
+    flag_modified(setup, "stats")
+    return True
+
+
+def refresh_setup_stats(topic_id: int, model: str, temperature: float, rating_last: bool, answer_english: bool,
+                        question_english: bool, full: bool = False):
+    """Update the stats of the setups with these settings (called after new answers were stored)"""
+    with Session(get_engine()) as session:
+        setups = session.query(Setup).filter_by(
+            topic_id=topic_id, model=model, temperature=temperature, rating_last=rating_last,
+            answer_english=answer_english, question_english=question_english
+        ).all()
+        for setup in setups:
+            if update_setup_stats(session, setup, setup.topic, full=full):
+                print(f"Updated stats for setup {setup.name}")
+        session.commit()
+
+
+def calc_setup_stats(setup_id: int, full: bool = False) -> dict:
+    """Calculate the stats of a setup without storing them (runs in the worker processes of analyze_results)
+
+    :return: New values of the stats columns of the setup (empty if nothing changed)
+    """
+    with Session(get_engine()) as session:
+        setup = session.get(Setup, setup_id)
+        print(f"Calculating stats for setup {setup.name}")
+        if not update_setup_stats(session, setup, setup.topic, full=full):
+            return {}
+        return {key: getattr(setup, key)
+                for key in ["ratings_summary", "stats", "stats_answer_id", "stats_answer_count", "stats_version"]}
+
+
+async def analyze_results(setup_name: str, full: bool = False, workers: int = 1, plots: bool = False):
+    """Calculate the stats of one or all setups and store them in one transaction
+
+    :param setup_name: Name of the setup in setups.json ("all" for all setups)
+    :param full: Recalculate the stats from all answers
+    :param workers: Number of processes that calculate setups in parallel (0: one per CPU core)
+    :param plots: Pre-render the plots of the app from the new stats
+    """
     add_setups()
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         if setup_name == "all" or not setup_name:
             setups = session.query(Setup).all()
         else:
             setups = session.query(Setup).filter_by(name=setup_name).all()
-
-        topics = session.query(Topic).all()
-
-        for setup in setups:
-            print(f"Calculating stats for setup {setup.name}")
-            topic = [topic for topic in topics if topic.id == setup.topic_id][0]
-            params = setup.dict()
-            [params.pop(key) for key in ["stats", "id", "name"]]
-            all_stats = await calc_stats(topic, params)
-            setup.stats = all_stats
-            flag_modified(setup, "stats")
-            session.commit()
+        setup_ids = [setup.id for setup in setups]
+
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(setup_ids) > 1:
+        # Each worker opens its own database connection and only loads the ratings of its setup
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(setup_ids)), mp_context=context) as executor:
+            results = await asyncio.gather(
+                *[loop.run_in_executor(executor, calc_setup_stats, setup_id, full) for setup_id in setup_ids],
+                return_exceptions=True
+            )
+    else:
+        results = []
+        for setup_id in setup_ids:
+            try:
+                results.append(calc_setup_stats(setup_id, full))
+            except Exception as e:
+                results.append(e)
+
+    with Session(get_engine()) as session:
+        for setup_id, result in zip(setup_ids, results):
+            if isinstance(result, Exception):
+                print(f"Failed to calculate stats for setup {setup_id}: {result}")
+            elif result:
+                session.get(Setup, setup_id).update(result)
+        session.commit()
+
+    if plots:
+        prerender_plots(setup_name)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calc discrepancies for setups.")
     parser.add_argument("--setup", default="A) default (rating first, temperature=0, gpt-4o)",
                         help="name of the setup in setups.json")
+    parser.add_argument("--full", action="store_true", default=False,
+                        help="Recalculate the stats from all answers (instead of adding the new answers)")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of processes that calculate setups in parallel (0: one per CPU core)")
+    parser.add_argument("--plots", action="store_true", default=False,
+                        help="Pre-render the plots of the app after calculating the stats")
     args = parser.parse_args()
 
-    asyncio.run(analyze_results(args.setup))
+    asyncio.run(analyze_results(args.setup, args.full, args.workers, args.plots))
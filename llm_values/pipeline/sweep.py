@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import sys
+from collections import defaultdict
+
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Topic
+from llm_values.pipeline.step_1_translate_prompts import translate_prompts
+from llm_values.pipeline.step_2_query_llms import query_llms, prepare_formats
+from llm_values.pipeline.step_3_translate_answers import translate_answers
+from llm_values.pipeline.step_4_analyze_results import analyze_results
+from llm_values.utils.gpt import get_provider
+from llm_values.utils.llm_cost import estimate_cost, confirm_to_continue
+from llm_values.utils.utils import load_json_file
+
+
+def get_sweep_jobs(setup_name: str = "all") -> list[dict]:
+    """Expand the setups in setups.json into one job (arguments of query_llms) per setup and topic
+
+    Setups with the same parameters share their answers, so every combination of parameters and topic is queried once.
+    """
+    all_setups = load_json_file("setups.json", "data")
+    if setup_name != "all":
+        if setup_name not in all_setups:
+            raise ValueError(f"Setup '{setup_name}' not found in setups.json.")
+        all_setups = {setup_name: all_setups[setup_name]}
+
+    jobs = {}
+    for setup, params in all_setups.items():
+        for topic in params.get("topics", []):
+            job = {key: value for key, value in params.items() if key != "topics"}
+            job["topic"] = topic
+            jobs.setdefault(tuple(sorted(job.items())), job)
+    return list(jobs.values())
+
+
+def load_questions(topic: str, testing: bool = False) -> list:
+    with Session(get_engine()) as session:
+        topic_object = session.query(Topic).filter(Topic.name == topic).first()
+        if not topic_object:
+            topic_object = session.query(Topic).filter(Topic.filename == topic).first()
+        if not topic_object:
+            return []
+        questions = topic_object.questions
+    return questions[:1] if testing else questions
+
+
+async def sweep(
+        setup_name: str = "all",
+        num_queries: int = 3,
+        max_tokens: int = 100,
+        testing: bool = False,
+        overwrite: bool = False,
+        budget: float = 1.0,
+        translate: bool = True,
+        analyze: bool = False
+) -> list[dict]:
+    """Query all setups × topics of setups.json, with the calls of the different providers running in parallel
+
+    The questions of every topic and the formats of every combination of settings are translated once before the
+    queries. The jobs are grouped by provider (OpenAI, Anthropic, Mistral): the jobs of a provider run one after the
+    other, the providers run at the same time (each with its own thread pool and rate limits, see GPT.get_executor).
+    :param setup_name: Name of the setup in setups.json ("all" for all setups)
+    :param num_queries: Number of repeated questions (with exact same settings)
+    :param max_tokens: Max tokens for LLM response
+    :param testing: Testing mode (reduced number of questions)
+    :param overwrite: Whether to overwrite previous answers (otherwise skip existing answers)
+    :param budget: Budget for all LLM queries of the sweep. Get warning if exceeded (confirmed once before the
+        queries, the translations of questions and answers run without confirmation)
+    :param translate: Translate the new answers (once per topic, after all its jobs are done)
+    :param analyze: Calculate the stats of the setups and render their plots afterwards
+    :return: Failed jobs (arguments of query_llms and the error)
+    """
+    languages = load_json_file('languages.json')
+    jobs = []
+    for job in get_sweep_jobs(setup_name):
+        if job["question_english"] and job["answer_english"]:
+            print(f"Skipping {job['model']} for topic {job['topic']}: both question and answer cannot be in English")
+        elif not load_questions(job["topic"]):
+            print(f"Skipping {job['model']} for topic {job['topic']}: topic not found (run step_0_prepare_prompts)")
+        else:
+            jobs.append(job)
+    if not jobs:
+        return []
+    topics = sorted({job["topic"] for job in jobs})
+
+    # Translate the questions of every topic once (shared by all setups of the topic)
+    await asyncio.gather(*[
+        translate_prompts(topic, testing=testing, budget=float("inf")) for topic in topics
+        if not all(question.translations for question in load_questions(topic, testing))
+    ])
+    questions = {topic: load_questions(topic, testing) for topic in topics}
+
+    # Translate the formats of every combination of settings once (cached, query_llms loads them from the cache)
+    format_keys = {
+        (job["rating_last"], job["question_english"], job["answer_english"], question.mode)
+        for job in jobs for question in questions[job["topic"]]
+    }
+    format_keys = list(format_keys)
+    all_formats = dict(zip(format_keys, await asyncio.gather(*[
+        prepare_formats(rating_last, question_english, answer_english, max_tokens, languages, mode=mode)
+        for rating_last, question_english, answer_english, mode in format_keys
+    ])))
+
+    # Confirm the cost of the whole sweep once (instead of once per job), every query sends question, prefix and format
+    def get_job_strings(job: dict) -> list[str]:
+        strings = []
+        for question in questions[job["topic"]]:
+            prefixes, formats, _, _ = all_formats[
+                (job["rating_last"], job["question_english"], job["answer_english"], question.mode)
+            ]
+            strings += list((question.translations or {}).values()) + list(prefixes.values()) + list(formats.values())
+        return strings
+
+    cost = sum(
+        estimate_cost(get_job_strings(job), multiplier=num_queries, model=job["model"], max_token=max_tokens,
+                      budget=float("inf"))
+        for job in jobs
+    )
+    print(f"Estimated cost of the sweep ({len(jobs)} jobs): ${cost:.2f}")
+    if cost > budget:
+        confirm_to_continue(f"This sweep will cost approximately ${cost:.2f}.")
+
+    provider_jobs = defaultdict(list)
+    for job in jobs:
+        provider_jobs[get_provider(job["model"])].append(job)
+
+    failures = []
+
+    async def run_provider(provider: str):
+        for job in provider_jobs[provider]:
+            print(f"[{provider}] Querying {job['model']} for topic {job['topic']}...")
+            try:
+                await query_llms(**job, num_queries=num_queries, max_tokens=max_tokens, testing=testing,
+                                 overwrite=overwrite, budget=float("inf"))
+            except Exception as e:
+                # The other jobs go on, missing answers are queried in the next sweep
+                print(f"[{provider}] Query of {job['model']} for topic {job['topic']} failed: {e}")
+                failures.append({**job, "error": str(e)})
+
+    await asyncio.gather(*[run_provider(provider) for provider in provider_jobs])
+
+    if translate:
+        for topic in topics:
+            await translate_answers(topic, testing=testing, budget=float("inf"))
+    if analyze:
+        await analyze_results(setup_name, plots=True)
+
+    if failures:
+        print(f"{len(failures)} of {len(jobs)} jobs failed (run the sweep again to query the missing answers):")
+        for failure in failures:
+            print(f"  {failure['model']} for topic {failure['topic']}: {failure['error']}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query all setups and topics in setups.json.")
+    parser.add_argument("--setup", dest="setup_name", default="all",
+                        help="name of the setup in setups.json (all: all setups)")
+    parser.add_argument("--num_queries", default=3, type=int, help="How often each question should be repeated")
+    parser.add_argument("--max_tokens", default=100, type=int,
+                        help="max token for response (+20% will be added to be safe)")
+    parser.add_argument("--testing", action="store_true", default=False, help="Run the script in testing mode")
+    parser.add_argument("--overwrite", action="store_true", default=False, help="Overwrite previous answers")
+    parser.add_argument("--budget", default=1.0, type=float,
+                        help="How much you want to spend on the sweep (get a warning if budget is exceeded)")
+    parser.add_argument("--no_translate", dest="translate", action="store_false", default=True,
+                        help="Do not translate the answers")
+    parser.add_argument("--analyze", action="store_true", default=False,
+                        help="Calculate the stats and plots of the setups afterwards")
+    args = parser.parse_args()
+
+    if asyncio.run(sweep(**args.__dict__)):
+        sys.exit(1)
@@ -0,0 +1,58 @@
+from decouple import config
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Answer
+from llm_values.utils.work_ledger import remove_stored, DONE
+
+
+class AnswerWriter:
+    """Collects queried answers and stores them in bulk (one transaction per batch_size answers).
+
+    New answers are inserted, stored answers (with re-queried languages) are updated.
+    Use as context manager, the remaining answers are stored on exit.
+    """
+
+    def __init__(self, languages: list[str], batch_size: int = None):
+        self.languages = languages
+        self.batch_size = batch_size or config("ANSWER_WRITE_BATCH_SIZE", default=500, cast=int)
+        self.buffer = []
+        self.written = 0
+        self.repaired = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def is_complete(self, answer) -> bool:
+        """Only store answers with a result (response or error) in every language and at least one response"""
+        if not isinstance(answer, Answer):
+            return False
+        cells = {cell.language: cell.status for cell in answer.cells}
+        return all(language in cells for language in self.languages) and DONE in cells.values()
+
+    def add(self, answer) -> bool:
+        if not self.is_complete(answer):
+            return False
+        self.buffer.append(answer)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.buffer:
+            return
+        new_answers = [answer for answer in self.buffer if answer.id is None]
+        repaired_answers = [answer for answer in self.buffer if answer.id is not None]
+        with Session(get_engine(), expire_on_commit=False) as session:
+            # Inserted in batches (together with their cells)
+            session.add_all(new_answers)
+            for answer in repaired_answers:
+                session.merge(answer)
+            # The calls of the stored answers are done, their checkpoints are removed in the same transaction
+            remove_stored(session, self.buffer)
+            session.commit()
+        self.written += len(new_answers)
+        self.repaired += len(repaired_answers)
+        self.buffer = []
@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from datetime import datetime
+
+from decouple import config
+
+from llm_values.utils.gpt import GPT, get_llm, get_provider, openai_aliases
+
+batch_dir = ".cache/batches/"
+
+# OpenAI accepts at most 50000 requests per batch
+max_batch_size = 50000
+
+
+def make_batch_request(custom_id: str, model: str, conversation: list, **kwargs) -> dict:
+    """Build one line of a batch job (OpenAI batch format)"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": openai_aliases.get(model, model), "messages": conversation, **kwargs}
+    }
+
+
+def get_job_path(requests: list[dict], name: str, backend) -> str:
+    """Path of the record of a submitted job with these requests (deleted when its results are collected)"""
+    content = json.dumps([type(backend).__name__, requests], sort_keys=True, ensure_ascii=False)
+    return os.path.join(batch_dir, f"{name}_{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}.job.json")
+
+
+def submit_job(requests: list[dict], name: str, backend) -> tuple[str, str]:
+    """Submit the requests as a batch job, or resume the job submitted with the same requests by a crashed run
+
+    :return: Batch id and path of the job record
+    """
+    job_path = get_job_path(requests, name, backend)
+    if os.path.exists(job_path):
+        with open(job_path, "r", encoding="utf-8") as f:
+            batch_id = json.load(f)["batch_id"]
+        print(f"Resuming batch {batch_id} ({len(requests)} requests)")
+        return batch_id, job_path
+
+    file_path = write_batch_file(requests, name)
+    batch_id = backend.submit(file_path)
+    # Recorded before polling (which can take up to 24h), so that an interrupted run does not submit the job again
+    with open(f"{job_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"batch_id": batch_id, "file": file_path, "submitted": datetime.utcnow().isoformat()}, f)
+    os.replace(f"{job_path}.tmp", job_path)
+    print(f"Submitted batch {batch_id} ({len(requests)} requests)")
+    return batch_id, job_path
+
+
+def write_batch_file(requests: list[dict], name: str) -> str:
+    os.makedirs(batch_dir, exist_ok=True)
+    file_path = os.path.join(batch_dir, f"{name}_{datetime.utcnow():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.jsonl")
+    with open(file_path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return file_path
+
+
+class OpenAIBatchBackend:
+    """Batch API of OpenAI (50% cheaper, results within 24h, separate rate limits)"""
+
+    def __init__(self, llm: GPT):
+        self.client = llm.openai
+
+    def submit(self, file_path: str) -> str:
+        with open(file_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    async def poll(self, batch_id: str) -> str:
+        batch = await asyncio.get_running_loop().run_in_executor(None, self.client.batches.retrieve, batch_id)
+        return batch.status
+
+    def results(self, batch_id: str) -> list[dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                lines += self.client.files.content(file_id).text.splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+class LocalBatchBackend:
+    """File-based stand-in for a batch endpoint: the job is executed with normal chat completions on the first poll.
+
+    Works for all providers. With testing=True no LLM is called and every request is answered with a dummy text.
+    """
+
+    def __init__(self, llm: GPT, testing: bool = False):
+        self.llm = llm
+        self.testing = testing
+
+    async def respond(self, body: dict) -> str:
+        if self.testing:
+            return f"test [[5]] {body['messages'][-1]['content'][:50]}"
+        body = dict(body)
+        model, conversation = body.pop("model"), body.pop("messages")
+        return await self.llm.complete(model, conversation, json_mode=False, **body)
+
+    async def respond_result(self, request: dict) -> dict:
+        try:
+            content = await self.respond(request["body"])
+            return {
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+                "error": None
+            }
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+
+    def submit(self, file_path: str) -> str:
+        return file_path
+
+    async def poll(self, batch_id: str) -> str:
+        output_path = batch_id.replace(".jsonl", "_output.jsonl")
+        if os.path.exists(output_path):
+            return "completed"
+
+        with open(batch_id, "r", encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        # Requests run concurrently in the thread pool of the provider (bounded by <PROVIDER>_MAX_CONCURRENCY)
+        results = await asyncio.gather(*[self.respond_result(request) for request in requests])
+        with open(output_path, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        return "completed"
+
+    def results(self, batch_id: str) -> list[dict]:
+        with open(batch_id.replace(".jsonl", "_output.jsonl"), "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def get_batch_backend(model: str, testing: bool = False):
+    """Get the batch backend for a model from BATCH_BACKEND (openai/local/test), only OpenAI models have a batch API
+
+    :param model: LLM model of the requests
+    :param testing: Use the test backend (no LLM calls) regardless of BATCH_BACKEND
+    """
+    llm = get_llm()
+    backend = config("BATCH_BACKEND", default="openai")
+    if testing or backend == "test":
+        return LocalBatchBackend(llm, testing=True)
+    if backend == "openai" and get_provider(model) == "openai":
+        return OpenAIBatchBackend(llm)
+    if backend == "openai":
+        print(f"No batch API for model {model}, running batch locally")
+    return LocalBatchBackend(llm)
+
+
+def get_result_text(result: dict):
+    response = result.get("response")
+    if result.get("error") or not response or response.get("status_code") != 200:
+        return None
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+async def run_batch(requests: list[dict], name: str, backend, poll_interval: float = None) -> dict[str, str]:
+    """Write requests as JSONL job(s), submit them to the batch backend, wait for completion and collect the results
+
+    Jobs that an interrupted run submitted with the same requests are not submitted again, their polling is resumed.
+
+    :param requests: Batch requests (see make_batch_request)
+    :param name: Name of the job (prefix of the JSONL file)
+    :param backend: Batch backend (see get_batch_backend)
+    :param poll_interval: Seconds between status checks
+    :return: Response text per custom_id (failed requests are missing)
+    """
+    poll_interval = poll_interval or config("BATCH_POLL_INTERVAL", default=60, cast=float)
+    jobs = [submit_job(requests[i:i + max_batch_size], name, backend) for i in range(0, len(requests), max_batch_size)]
+
+    texts = {}
+    for batch_id, job_path in jobs:
+        while True:
+            status = await backend.poll(batch_id)
+            if status == "completed":
+                break
+            if status in ["failed", "expired", "cancelled"]:
+                print(f"Batch {batch_id} {status}")
+                break
+            await asyncio.sleep(poll_interval)
+
+        # Expired batches still contain the results of the completed requests
+        if status in ["completed", "expired"]:
+            for result in backend.results(batch_id):
+                text = get_result_text(result)
+                if text is not None:
+                    texts[result["custom_id"]] = text
+                else:
+                    print(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+        os.remove(job_path)
+
+    return texts
@@ -1,14 +1,15 @@
 import asyncio
+import functools
 import logging
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from typing import List, TypedDict, Optional
 
-import anthropic
 from decouple import config
-from mistralai.client import MistralClient
-from mistralai.models.chat_completion import ChatMessage
-from openai import OpenAI
+
+from llm_values.utils.rate_limit import RateLimiter, estimate_request_tokens, get_used_tokens
+from llm_values.utils.retry import RetryPolicy
 
 logging.basicConfig(level=logging.WARNING)
 
@@ -24,14 +25,92 @@ class ChatCompletion(TypedDict):
     conversation: List[GptMessage]
 
 
+openai_aliases = {
+    "gpt-4": "gpt-4-0125-preview",
+    "gpt-4o": "gpt-4o-2024-11-20",
+    "gpt-4o-mini": "gpt-4o-mini-2024-07-18",
+    "o1": "o1-2024-12-17",
+    "gpt-3.5": "gpt-3.5-turbo-0125",
+}
+
+
+def get_provider(model: str) -> str:
+    if model.lower().startswith("gpt"):
+        return "openai"
+    elif model.lower().startswith("claude"):
+        return "anthropic"
+    elif model.lower().startswith("mistral"):
+        return "mistral"
+    raise Exception(f"Unknown model: {model}")
+
+
 class GPT:
-    def __init__(self):
-        self.executor = ThreadPoolExecutor()
+    def __init__(self, max_concurrency: int = None):
+        # Upper bound of calls in flight at the same time per provider (shared by all async callers)
+        self.max_concurrency = max_concurrency or config("LLM_MAX_CONCURRENCY", default=16, cast=int)
+        self.executors = {}
+        self.rate_limiter = RateLimiter()
+        self.retry_policy = RetryPolicy()
         self.completion_log: List[ChatCompletion] = []
         self.listeners = set()
-        self.openai = OpenAI(api_key=config("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY")))
-        self.mistral = MistralClient(api_key=config("MISTRAL_API_KEY", os.getenv("MISTRAL_API_KEY")))
-        self.anthropic = anthropic.Anthropic(api_key=config("ANTHROPIC_API_KEY", os.getenv("ANTHROPIC_API_KEY")))
+        # SDK clients are created on first use (importing and configuring them is slow)
+        self.lock = threading.Lock()
+        self._openai = None
+        self._mistral = None
+        self._anthropic = None
+
+    def get_http_client(self):
+        """HTTP client with a connection pool large enough to keep a connection alive for every worker"""
+        import httpx
+
+        limits = httpx.Limits(
+            max_connections=2 * self.max_concurrency,
+            max_keepalive_connections=self.max_concurrency,
+            keepalive_expiry=60
+        )
+        return httpx.Client(limits=limits, timeout=httpx.Timeout(600, connect=10), follow_redirects=True)
+
+    # Retries are handled by self.retry_policy, not by the SDKs
+    @property
+    def openai(self):
+        with self.lock:
+            if self._openai is None:
+                from openai import OpenAI
+                self._openai = OpenAI(api_key=config("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY")), max_retries=0,
+                                      http_client=self.get_http_client())
+        return self._openai
+
+    @property
+    def anthropic(self):
+        with self.lock:
+            if self._anthropic is None:
+                import anthropic
+                self._anthropic = anthropic.Anthropic(
+                    api_key=config("ANTHROPIC_API_KEY", os.getenv("ANTHROPIC_API_KEY")), max_retries=0,
+                    http_client=self.get_http_client()
+                )
+        return self._anthropic
+
+    @property
+    def mistral(self):
+        with self.lock:
+            if self._mistral is None:
+                from mistralai.client import MistralClient
+                self._mistral = MistralClient(api_key=config("MISTRAL_API_KEY", os.getenv("MISTRAL_API_KEY")),
+                                              max_retries=0)
+        return self._mistral
+
+    def get_executor(self, model: str) -> ThreadPoolExecutor:
+        """Thread pool of the provider of the model (<PROVIDER>_MAX_CONCURRENCY workers, default max_concurrency)
+
+        Every provider has its own pool, so calls waiting for the rate limit of one provider do not block the others.
+        """
+        provider = get_provider(model)
+        with self.lock:
+            if provider not in self.executors:
+                max_workers = config(f"{provider.upper()}_MAX_CONCURRENCY", default=self.max_concurrency, cast=int)
+                self.executors[provider] = ThreadPoolExecutor(max_workers=max_workers)
+        return self.executors[provider]
 
     def get_completion_log(self) -> List[ChatCompletion]:
         return self.completion_log
@@ -68,99 +147,126 @@ class GPT:
     async def create_conversation_completion(
             self, model, conversation: List[GptMessage], json_mode: bool, **kwargs
     ):
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         chat_completion = await loop.run_in_executor(
-            self.executor,
-            self._create_conversation_completion,
-            model,
-            conversation,
-            json_mode,
-            **kwargs
+            self.get_executor(model),
+            functools.partial(self._create_conversation_completion, model, conversation, json_mode, **kwargs)
         )
         response = chat_completion.choices[0].message
         await self.log_response(response, model, conversation)
 
         return response
 
+    async def complete(self, model: str, conversation: List[GptMessage], json_mode: bool = False, **kwargs) -> str:
+        """Run a chat completion in the thread pool of the provider (see get_executor) and return the text
+
+        :param model: LLM model to query (OpenAI, Anthropic or Mistral)
+        :param conversation: List of messages
+        :param json_mode: Force JSON output (OpenAI only)
+        :return: Content of the response message
+        """
+        loop = asyncio.get_running_loop()
+        chat_completion = await loop.run_in_executor(
+            self.get_executor(model),
+            functools.partial(self._create_conversation_completion, model, conversation, json_mode, **kwargs)
+        )
+        return self.get_text(model, chat_completion)
+
+    @staticmethod
+    def get_text(model: str, chat_completion) -> str:
+        if get_provider(model) == "anthropic":
+            return chat_completion.content[0].text
+        return chat_completion.choices[0].message.content
+
     def _create_conversation_completion(
             self, model: str, conversation: list, json_mode: bool, stream: bool = False, **kwargs
     ):
         logging.info(f"Creating chat completion for conversation {conversation}")
 
         try:
-            if model.lower().startswith("gpt"):
-                if model == "gpt-4":
-                    actual_model = "gpt-4-0125-preview"
-                elif model == "gpt-4o":
-                    actual_model = "gpt-4o-2024-11-20"
-                elif model == "gpt-4o-mini":
-                    actual_model = "gpt-4o-mini-2024-07-18"
-                elif model == "o1":
-                    actual_model = "o1-2024-12-17"
-                elif model == "gpt-3.5":
-                    actual_model = "gpt-3.5-turbo-0125"
-                else:
-                    actual_model = model
+            return self.retry_policy.call(self._send_completion, model, conversation, json_mode, stream, **kwargs)
+        except Exception as e:
+            logging.error(f"Error during chat completion: {e}")
+            raise
 
-                logging.info(f"Using openai for: {conversation}")
-                chat_completion = self.openai.chat.completions.create(
+    def _send_completion(self, model: str, conversation: list, json_mode: bool, stream: bool = False, **kwargs):
+        provider = get_provider(model)
+        actual_model = openai_aliases.get(model, model) if provider == "openai" else model
+
+        estimated_tokens = estimate_request_tokens(conversation, kwargs.get("max_tokens"))
+        self.rate_limiter.acquire(provider, actual_model, estimated_tokens)
+
+        if provider == "openai":
+            logging.info(f"Using openai for: {conversation}")
+            chat_completion = self.openai.chat.completions.create(
+                messages=conversation,
+                model=actual_model,  # gpt-4-turbo-preview, gpt-4-1106-preview, gpt-4-vision-preview, gpt-4
+                stream=stream,
+                response_format={"type": "json_object" if json_mode else "text"},
+                **kwargs
+            )
+
+        elif provider == "anthropic":
+
+            if not stream:
+                chat_completion = self.anthropic.messages.create(
+                    model=model,
+                    messages=conversation,
+                    **kwargs
+                )
+            else:
+                chat_completion = self.anthropic.messages.stream(
                     messages=conversation,
-                    model=actual_model,  # gpt-4-turbo-preview, gpt-4-1106-preview, gpt-4-vision-preview, gpt-4
-                    stream=stream,
-                    response_format={"type": "json_object" if json_mode else "text"},
+                    model=model,
                     **kwargs
                 )
 
-            elif model.lower().startswith("claude"):
+        elif provider == "mistral":
+            from mistralai.models.chat_completion import ChatMessage
 
-                if not stream:
-                    chat_completion = self.anthropic.messages.create(
-                        model=model,
-                        messages=conversation,
-                        **kwargs
+            logging.info(f"Using mistral for: {conversation}")
+            messages = []
+            for message in conversation:
+                if isinstance(message, dict):
+                    messages.append(
+                        ChatMessage(
+                            role=message["role"], content=message["content"]
+                        )
                     )
                 else:
-                    chat_completion = self.anthropic.messages.stream(
-                        messages=conversation,
-                        model=model,
-                        **kwargs
+                    messages.append(
+                        ChatMessage(role=message.role, content=message.content)
                     )
 
-            elif model.lower().startswith("mistral"):
-                logging.info(f"Using mistral for: {conversation}")
-                messages = []
-                for message in conversation:
-                    if isinstance(message, dict):
-                        messages.append(
-                            ChatMessage(
-                                role=message["role"], content=message["content"]
-                            )
-                        )
-                    else:
-                        messages.append(
-                            ChatMessage(role=message.role, content=message.content)
-                        )
+            chat_call = self.mistral.chat_stream if stream else self.mistral.chat
+            chat_completion = chat_call(
+                model=model,  # mistral-tiny, mistral-small, mistral-medium
+                messages=messages,
+                safe_mode=True,
+                **kwargs
+            )
 
-                chat_call = self.mistral.chat_stream if stream else self.mistral.chat
-                chat_completion = chat_call(
-                    model=model,  # mistral-tiny, mistral-small, mistral-medium
-                    messages=messages,
-                    safe_mode=True,
-                    **kwargs
-                )
-
-            else:
-                raise Exception(f"Unknown model: {model}")
+        logging.info(f"Chat completion {chat_completion}")
 
-            logging.info(f"Chat completion {chat_completion}")
+        if not stream:
+            self.rate_limiter.correct(provider, actual_model, estimated_tokens, get_used_tokens(chat_completion))
 
-            return chat_completion
-
-        except Exception as e:
-            logging.error(f"Error during chat completion: {e}")
-            raise
+        return chat_completion
 
     def chat(self, prompt: str, model: str, json_mode: bool = False):
         conversation = [{"role": "user", "content": prompt}]
         response = self._create_conversation_completion(model, conversation, json_mode=json_mode)
-        return response.choices[0].message.content
+        return self.get_text(model, response)
+
+
+_llm = None
+_llm_lock = threading.Lock()
+
+
+def get_llm() -> GPT:
+    """Get the process-wide GPT client (created on first use and shared by all pipeline steps)"""
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = GPT()
+    return _llm
@@ -1,6 +1,4 @@
-import tiktoken
-
-encoding = tiktoken.get_encoding("cl100k_base")
+import functools
 
 llm_prices = {
     "o1-2024-12-17": {
@@ -68,8 +66,16 @@ def confirm_to_continue(message):
 #
 #     return estimated_tokens
 
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    # Loading the BPE ranks takes a while, so only do it when tokens are counted
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
 def estimate_tokens(text):
-    tokens = encoding.encode(text)
+    tokens = get_encoding().encode(text)
 
     return len(tokens)
 
@@ -83,6 +89,7 @@ def estimate_cost(items, multiplier=1, output_multiplier=1, max_token: int = Non
     :param output_multiplier: How much longer the output (response) is compared to the input (prompt)
     :param model: llm model to query
     :param budget: budget for you llm calls (get a warning if exceeded)
+    :return: Estimated cost in $
     """
 
     whole_string = " ".join(items)
@@ -97,3 +104,4 @@ def estimate_cost(items, multiplier=1, output_multiplier=1, max_token: int = Non
     if cost > budget:
         warning_message = f"This LLM query will cost approximately ${cost:.2f}."
         confirm_to_continue(warning_message)
+    return cost
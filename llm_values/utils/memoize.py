@@ -0,0 +1,55 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import os
+
+
+def async_cache(cache_dir: str):
+    """Memoize an async function with JSON-serializable arguments and result.
+
+    Results are kept in memory and persisted as JSON files in cache_dir (so they survive the run).
+    Concurrent calls with the same arguments share one computation. Exceptions are not cached.
+    Note: the result is returned as loaded from JSON (tuples become lists).
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        results = {}
+        pending = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = hashlib.sha256(json.dumps(arguments.arguments, sort_keys=True).encode("utf-8")).hexdigest()
+            if key in results:
+                return results[key]
+
+            file_path = os.path.join(cache_dir, f"{func.__name__}_{key}.json")
+            if os.path.exists(file_path):
+                with open(file_path, "r", encoding="utf-8") as f:
+                    results[key] = json.load(f)
+                return results[key]
+
+            if key not in pending:
+                pending[key] = asyncio.ensure_future(func(*args, **kwargs))
+            try:
+                result = await asyncio.shield(pending[key])
+            finally:
+                if key in pending and pending[key].done():
+                    pending.pop(key)
+
+            if key not in results:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(result, f, ensure_ascii=False)
+                os.replace(tmp_path, file_path)
+                results[key] = json.loads(json.dumps(result))
+            return results[key]
+
+        return wrapper
+
+    return decorator
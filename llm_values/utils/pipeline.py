@@ -0,0 +1,55 @@
+import asyncio
+
+# Marks the end of the items in a queue (one per worker of the next stage)
+_done = object()
+
+
+def _describe(item) -> str:
+    """Short name of an item for the log, never raises (e.g. for ORM objects whose session is closed)"""
+    try:
+        item_id = getattr(item, "id", None)
+    except Exception:
+        item_id = None
+    return f"{type(item).__name__}(id={item_id})"
+
+
+async def run_pipeline(items: list, stages: list[tuple], queue_size: int = 8):
+    """Stream items through async stages that are connected by bounded queues
+
+    Every stage processes an item as soon as the previous stage has produced it, so all stages run at the same time.
+    The bounded queues stop a fast stage from running too far ahead of a slow one.
+    :param items: Input items of the first stage
+    :param stages: List of (async function, number of workers). The function gets one item and returns a list of
+        items for the next stage. Failed items are skipped.
+    :param queue_size: Maximum number of items waiting in front of a stage
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+
+    async def feed():
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(stages[0][1]):
+            await queues[0].put(_done)
+
+    async def work(k: int, func):
+        while True:
+            item = await queues[k].get()
+            if item is _done:
+                return
+            name = _describe(item)
+            try:
+                results = await func(item)
+            except Exception as e:
+                print(f"Pipeline stage {func.__name__} failed for {name}: {e}")
+                continue
+            if k + 1 < len(stages):
+                for result in results or []:
+                    await queues[k + 1].put(result)
+
+    async def run_stage(k: int, func, workers: int):
+        await asyncio.gather(*[work(k, func) for _ in range(workers)])
+        if k + 1 < len(stages):
+            for _ in range(stages[k + 1][1]):
+                await queues[k + 1].put(_done)
+
+    await asyncio.gather(feed(), *[run_stage(k, func, workers) for k, (func, workers) in enumerate(stages)])
@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+from decouple import config
+
+from llm_values.utils.llm_cost import estimate_tokens
+from llm_values.utils.utils import load_json_file
+
+
+class TokenBucket:
+    """Token bucket that refills continuously up to `per_minute` units per minute.
+
+    Reservations may drive the bucket into debt: the caller then has to wait until the debt is paid back,
+    so concurrent callers are scheduled one after another instead of all retrying at the same time.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` units from the bucket and return the time (in seconds) until they are available"""
+        self.level -= amount
+        return max(0., -self.level / self.rate)
+
+    def give_back(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute (rpm) and tokens-per-minute (tpm) limits per provider and per model.
+
+    Limits are read from data/rate_limits.json and can be overwritten with environment variables
+    like OPENAI_RPM / OPENAI_TPM. A missing or zero limit means unlimited.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = config("LLM_RATE_LIMIT", default=True, cast=bool)
+        try:
+            limits = load_json_file("rate_limits.json")
+        except FileNotFoundError:
+            logging.warning("No rate_limits.json found, only limits from environment variables are used")
+            limits = {}
+        self.provider_limits = limits.get("providers", {})
+        self.model_limits = limits.get("models", {})
+        self.buckets: dict[tuple[str, str, str], TokenBucket] = {}
+
+    def get_limit(self, scope: str, name: str, unit: str):
+        if scope == "provider":
+            limit = self.provider_limits.get(name, {}).get(unit)
+            return config(f"{name.upper()}_{unit.upper()}", default=limit or 0, cast=float)
+        return self.model_limits.get(name, {}).get(unit, 0)
+
+    def get_buckets(self, provider: str, model: str, unit: str) -> list[TokenBucket]:
+        buckets = []
+        for scope, name in [("provider", provider), ("model", model)]:
+            key = (scope, name, unit)
+            if key not in self.buckets:
+                limit = self.get_limit(scope, name, unit)
+                self.buckets[key] = TokenBucket(limit) if limit else None
+            if self.buckets[key] is not None:
+                buckets.append(self.buckets[key])
+        return buckets
+
+    def acquire(self, provider: str, model: str, tokens: int):
+        """Block until one request with `tokens` tokens may be sent to `model` of `provider`"""
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = 0.
+            for unit, amount in [("rpm", 1), ("tpm", tokens)]:
+                for bucket in self.get_buckets(provider, model, unit):
+                    bucket.refill(now)
+                    wait = max(wait, bucket.reserve(min(amount, bucket.capacity)))
+        if wait > 0:
+            logging.info(f"Rate limit for {provider}/{model} reached, waiting {wait:.1f}s")
+            time.sleep(wait)
+
+    def correct(self, provider: str, model: str, estimated_tokens: int, used_tokens: int):
+        """Correct the token reservation with the actual usage reported by the provider"""
+        if not self.enabled or used_tokens is None:
+            return
+        with self.lock:
+            for bucket in self.get_buckets(provider, model, "tpm"):
+                # Relative to the amount reserved in acquire (clamped to the capacity of the bucket)
+                bucket.give_back(min(estimated_tokens, bucket.capacity) - min(used_tokens, bucket.capacity))
+
+
+def estimate_request_tokens(conversation: list, max_tokens: int = None) -> int:
+    """Estimate the tokens a request counts against the tpm limit (prompt + maximal completion)"""
+    prompt = " ".join(
+        message["content"] if isinstance(message, dict) else message.content for message in conversation
+    )
+    prompt_tokens = estimate_tokens(prompt)
+    return prompt_tokens + (max_tokens if max_tokens else prompt_tokens)
+
+
+def get_used_tokens(chat_completion):
+    usage = getattr(chat_completion, "usage", None)
+    if usage is None:
+        return None
+    if hasattr(usage, "input_tokens"):
+        return usage.input_tokens + usage.output_tokens
+    return usage.total_tokens
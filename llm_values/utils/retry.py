@@ -0,0 +1,104 @@
+import logging
+import random
+import threading
+import time
+
+from decouple import config
+
+# HTTP status codes of transient errors (timeout, conflict, rate limit, server errors)
+retryable_status_codes = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Exception classes (or their parents) of transient network errors in the SDKs and httpx
+retryable_error_names = {
+    "APIConnectionError",  # openai, anthropic (includes APITimeoutError)
+    "MistralConnectionException",
+    "TransportError",  # httpx (timeouts, network and protocol errors)
+    "TimeoutError",
+    "ConnectionError",
+}
+
+
+def get_status_code(error: Exception):
+    status_code = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    return int(status_code) if status_code else None
+
+
+def get_retry_after(error: Exception):
+    """Get the wait time (in seconds) the provider asked for in the response headers (if any)"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Transient errors (rate limits, server errors, timeouts, connection problems) are worth a retry"""
+    while error is not None:
+        status_code = get_status_code(error)
+        if status_code is not None:
+            return status_code in retryable_status_codes
+        if any(cls.__name__ in retryable_error_names for cls in type(error).__mro__):
+            return True
+        error = error.__cause__
+    return False
+
+
+class RetryPolicy:
+    """Retry transient errors with exponential backoff and full jitter.
+
+    Retries are limited per call (max_attempts) and in total by a retry budget: every call earns
+    `budget_ratio` retries and at most `budget_max` retries can be saved up, so when a provider is down
+    we fail fast instead of multiplying the load.
+    """
+
+    def __init__(self, max_attempts: int = None, base_delay: float = None, max_delay: float = None,
+                 budget_ratio: float = None, budget_max: int = None):
+        self.max_attempts = max_attempts or config("LLM_MAX_ATTEMPTS", default=5, cast=int)
+        self.base_delay = base_delay or config("LLM_RETRY_BASE_DELAY", default=1.0, cast=float)
+        self.max_delay = max_delay or config("LLM_RETRY_MAX_DELAY", default=60.0, cast=float)
+        self.budget_ratio = budget_ratio if budget_ratio is not None else \
+            config("LLM_RETRY_BUDGET", default=0.2, cast=float)
+        self.budget_max = budget_max if budget_max is not None else 20
+        self.budget = float(self.budget_max)
+        self.lock = threading.Lock()
+
+    def get_delay(self, attempt: int, error: Exception) -> float:
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def take_retry(self) -> bool:
+        with self.lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            return True
+
+    def call(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) and retry transient errors"""
+        with self.lock:
+            self.budget = min(self.budget + self.budget_ratio, self.budget_max)
+
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e) or attempt >= self.max_attempts:
+                    raise
+                if not self.take_retry():
+                    logging.warning("Retry budget exhausted, not retrying")
+                    raise
+                delay = self.get_delay(attempt, e)
+                logging.warning(f"Transient error ({e.__class__.__name__}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
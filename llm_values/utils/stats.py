@@ -12,159 +12,212 @@ def extract_rating(s):
         return None  # Return None if no matching pattern is found
 
 
-def get_language_means(answers):
-    question_means = {}
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        question_means[language] = np.mean(ratings) if ratings else None
-    return question_means
-
-
-def get_language_std(answers):
-    question_means = {}
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        question_means[language] = np.std(ratings) if ratings else None
-    return question_means
-
-
-def get_discrepancy(answer):
-    """Get the discrepancy (standard deviation of ratings across languages) for a single answer
-
-    :param answer: Answer object
-    :return: Discrepancy (float) of answer
-    """
-    ratings = list(answer.ratings.values())
-    ratings = np.array([r for r in ratings if r is not None])
-    return float(ratings.std())
-
-
-def get_question_discrepancy(answers):
-    """Get the discrepancy (standard deviation of ratings across languages) for aggregated answers (same question+settings asked several times)
-
-    :param answers: Answer objects
-    :return: Discrepancy (float) of aggregated answers
-    """
-    means = []
-    for language in answers[0].answers:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        if ratings:
-            means.append(np.mean(ratings))
-    return np.array(means).std() if means else None
-
-
-def get_cleaned_question_discrepancy(answers):
-    """Get the discrepancy (standard deviation of ratings across languages) for aggregated answers (same question+settings asked several times)
-
-    :param answers: Answer objects
-    :return: Discrepancy (float) of aggregated answers
-    """
-    means = []
-    for language in answers[0].answers:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if (r is not None and int(r) != 5)]
-        if ratings:
-            means.append(np.mean(ratings))
-    return np.array(means).std() if means else None
-
-
-def get_question_assertiveness(answers):
-    means = []
-    for language in answers[0].answers:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        if ratings:
-            means.append(np.mean(ratings))
-    return np.sqrt(((np.array(means) - 5.) ** 2).mean()) if means else None
-
-
-def get_refusal_rates(answers):
-    """Get the refusal ratio (ratio of ratings of 5) for aggregated answers (same question+settings asked several times)
-    :param answers: Answer objects
-    :return: Ratio of refused answers
-    """
-    refusal_ratios = []
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        if ratings:
-            refusal_ratios.append(ratings.count(5) / len(ratings))
-    return np.mean(refusal_ratios) if refusal_ratios else 0
-
-
-def get_std(all_discrepancies: dict):
-    avery_discrepancy_list = list(all_discrepancies.values())
-    avery_discrepancy_list = [d for d in avery_discrepancy_list if d is not None]
-    average_discrepancy = np.array(avery_discrepancy_list).std()
-    return average_discrepancy
-
-
 def get_average(all_refusal_ratios: dict):
     average_refusal_list = list(all_refusal_ratios.values())
     average_refusal_list = [d for d in average_refusal_list if d is not None]
     average_refusal_ratio = np.array(average_refusal_list).mean()
     return average_refusal_ratio
 
-def get_failure_rates(answers):
-    all_rating_count = 0
-    all_failure_count = 0
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        all_rating_count += len(ratings)
-        all_failure_count += ratings.count(None)
-
-    return all_failure_count / all_rating_count
 
-def get_language_refusal_rate(answers):
-    language_refusals = {}
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        if ratings:
-            language_refusals[language] = ratings.count(5) / len(ratings)
 
-    return language_refusals
+def masked_mean(values: np.ndarray, mask: np.ndarray, axis) -> np.ndarray:
+    """Mean of the values where mask is True (NaN if there are none)"""
+    counts = mask.sum(axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(mask, values, 0.).sum(axis=axis) / np.where(counts > 0, counts, np.nan)
 
 
-def get_language_failure_rate(answers):
-    language_failure_rates = {}
-    languages = answers[0].answers
+def safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Element-wise ratio (NaN where the denominator is 0)"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
 
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        failures = [r for r in ratings if r is None]
-        language_failure_rates[language] = len(failures) / len(ratings)
 
-    return language_failure_rates
+def to_float(value):
+    return None if np.isnan(value) else float(value)
 
 
-def get_language_assertiveness(answers):
-    language_stds = {}
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if r is not None]
-        if ratings:
-            language_stds[language] = np.sqrt(((np.array(ratings) - 5.) ** 2).mean())
-    return language_stds
-
-
-def get_cleaned_language_assertiveness(answers):
-    language_stds = {}
-    languages = answers[0].answers
-    for language in languages:
-        ratings = [answer.ratings[language] for answer in answers]
-        ratings = [r for r in ratings if (r is not None and int(r) != 5)]
-        if ratings:
-            language_stds[language] = np.sqrt(((np.array(ratings) - 5.) ** 2).mean())
-    return language_stds
+class RatingsTensor:
+    """Ratings of a setup as one dense array of shape (questions, repetitions, languages).
 
+    Failed ratings are NaN, present marks the existing cells (questions can have different numbers of
+    repetitions, and the missing repetitions are padding).
+    """
 
+    def __init__(self, ratings: np.ndarray, present: np.ndarray, questions: list, languages: list[str]):
+        self.ratings = ratings
+        self.present = present
+        self.questions = questions
+        self.languages = languages
+
+    @classmethod
+    def from_ratings(cls, question_ratings: dict, languages: list[str] = None) -> "RatingsTensor":
+        """Build the tensor from the rating dicts (language -> rating or None) of the answers
+
+        :param question_ratings: Rating dicts of all repetitions per question (key)
+        :param languages: Languages (default: all languages of the ratings, in order of appearance)
+        """
+        if languages is None:
+            languages = list(dict.fromkeys(
+                language for ratings in question_ratings.values() for rating in ratings for language in rating
+            ))
+        questions = list(question_ratings)
+        repetitions = max([len(ratings) for ratings in question_ratings.values()], default=0)
+        language_index = {language: k for k, language in enumerate(languages)}
+
+        values = np.full((len(questions), repetitions, len(languages)), np.nan)
+        present = np.zeros(values.shape, dtype=bool)
+        for i, question in enumerate(questions):
+            for j, rating in enumerate(question_ratings[question]):
+                for language, value in rating.items():
+                    k = language_index.get(language)
+                    if k is not None:
+                        present[i, j, k] = True
+                        if value is not None:
+                            values[i, j, k] = value
+        return cls(values, present, questions, languages)
+
+    def summary(self) -> "RatingsSummary":
+        """Reduce the repetitions to sufficient statistics"""
+        valid = self.present & ~np.isnan(self.ratings)
+        ratings = np.where(valid, self.ratings, 0.)
+        refused = valid & (ratings == 5)
+        cleaned = valid & ~refused
+        return RatingsSummary(self.questions, self.languages, {
+            "present": self.present.sum(axis=1),
+            "valid": valid.sum(axis=1),
+            "sum": ratings.sum(axis=1),
+            "sumsq": (ratings ** 2).sum(axis=1),
+            "refused": refused.sum(axis=1),
+            "cleaned": cleaned.sum(axis=1),
+            "cleaned_sum": np.where(cleaned, ratings, 0.).sum(axis=1),
+            "cleaned_sumsq": np.where(cleaned, ratings ** 2, 0.).sum(axis=1)
+        })
+
+
+class RatingsSummary:
+    """Sufficient statistics of the ratings of a setup (arrays of shape (questions, languages)).
+
+    Counts of present, valid, refused (rating 5) and cleaned (valid and not refused) ratings, and the sums and sums of
+    squares of the (cleaned) ratings. Summaries of new answers can be added to an existing summary, all metrics are
+    computed from the summary.
+    """
+    fields = ["present", "valid", "sum", "sumsq", "refused", "cleaned", "cleaned_sum", "cleaned_sumsq"]
+
+    def __init__(self, questions: list, languages: list[str], counts: dict[str, np.ndarray]):
+        self.questions = questions
+        self.languages = languages
+        self.counts = counts
+
+    def __getattr__(self, name):
+        if name in RatingsSummary.fields:
+            return self.counts[name]
+        raise AttributeError(name)
+
+    def merge(self, other: "RatingsSummary") -> "RatingsSummary":
+        """Sum of two summaries (questions and languages are united)"""
+        questions = list(dict.fromkeys(self.questions + other.questions))
+        languages = list(dict.fromkeys(self.languages + other.languages))
+        counts = {field: np.zeros((len(questions), len(languages))) for field in RatingsSummary.fields}
+        for summary in [self, other]:
+            rows = np.array([questions.index(question) for question in summary.questions], dtype=int)
+            columns = np.array([languages.index(language) for language in summary.languages], dtype=int)
+            for field in RatingsSummary.fields:
+                counts[field][np.ix_(rows, columns)] += summary.counts[field]
+        return RatingsSummary(questions, languages, counts)
+
+    def to_dict(self) -> dict:
+        return {
+            "questions": self.questions,
+            "languages": self.languages,
+            "counts": {field: self.counts[field].tolist() for field in RatingsSummary.fields}
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RatingsSummary":
+        shape = (len(data["questions"]), len(data["languages"]))
+        counts = {field: np.array(data["counts"][field], dtype=float).reshape(shape) for field in cls.fields}
+        return cls(data["questions"], data["languages"], counts)
+
+    def language_means(self, cleaned: bool = False) -> np.ndarray:
+        """Mean rating per question and language (cleaned: without refusals, i.e. ratings of 5)"""
+        if cleaned:
+            return safe_divide(self.cleaned_sum, self.cleaned)
+        return safe_divide(self.sum, self.valid)
+
+    def language_std(self) -> np.ndarray:
+        means = self.language_means()
+        return np.sqrt(np.maximum(safe_divide(self.sumsq, self.valid) - means ** 2, 0.))
+
+    def question_discrepancy(self, cleaned: bool = False) -> np.ndarray:
+        """Standard deviation of the language means per question"""
+        means = self.language_means(cleaned)
+        mask = ~np.isnan(means)
+        centered = means - masked_mean(means, mask, axis=1)[:, None]
+        return np.sqrt(masked_mean(centered ** 2, mask, axis=1))
+
+    def question_assertiveness(self) -> np.ndarray:
+        """Root mean square distance of the language means from the neutral rating 5 per question"""
+        means = self.language_means()
+        return np.sqrt(masked_mean((means - 5.) ** 2, ~np.isnan(means), axis=1))
+
+    def refusal_rates(self) -> np.ndarray:
+        """Ratio of refusals (ratings of 5) per question, averaged over the languages with valid ratings"""
+        rates = safe_divide(self.refused, self.valid)
+        return np.nan_to_num(masked_mean(rates, ~np.isnan(rates), axis=1), nan=0.)
+
+    def failure_rates(self) -> np.ndarray:
+        """Ratio of failed ratings per question"""
+        return safe_divide((self.present - self.valid).sum(axis=1), self.present.sum(axis=1))
+
+    def language_refusal_rate(self) -> np.ndarray:
+        return safe_divide(self.refused.sum(axis=0), self.valid.sum(axis=0))
+
+    def language_failure_rate(self) -> np.ndarray:
+        return safe_divide((self.present - self.valid).sum(axis=0), self.present.sum(axis=0))
+
+    def language_assertiveness(self, cleaned: bool = False) -> np.ndarray:
+        """Root mean square distance of all ratings of a language from the neutral rating 5"""
+        if cleaned:
+            count, total, squares = self.cleaned.sum(axis=0), self.cleaned_sum.sum(axis=0), self.cleaned_sumsq.sum(axis=0)
+        else:
+            count, total, squares = self.valid.sum(axis=0), self.sum.sum(axis=0), self.sumsq.sum(axis=0)
+        # sum((r - 5)^2) = sum(r^2) - 10 sum(r) + 25 n
+        return np.sqrt(np.maximum(safe_divide(squares - 10. * total + 25. * count, count), 0.))
+
+    def per_question(self, values: np.ndarray) -> dict:
+        """Metric per question as dict (NaN becomes None)"""
+        return {question: to_float(value) for question, value in zip(self.questions, values)}
+
+    def per_language(self, values: np.ndarray) -> dict:
+        """Metric per language as dict (languages without value are dropped)"""
+        return {language: to_float(value) for language, value in zip(self.languages, values) if not np.isnan(value)}
+
+    def per_question_language(self, values: np.ndarray) -> dict:
+        """Metric per question and language as nested dict (only languages that were asked for the question)"""
+        return {question: {language: to_float(value) for language, value, present
+                           in zip(self.languages, question_values, question_present) if present > 0}
+                for question, question_values, question_present in zip(self.questions, values, self.present)}
+
+    def get_stats(self) -> dict:
+        """All metrics of a setup (as stored in Setup.stats)"""
+        all_stats = {
+            "discrepancies": self.per_question(self.question_discrepancy()),
+            "cleaned_discrepancies": self.per_question(self.question_discrepancy(cleaned=True)),
+            "assertivenesses": self.per_question(self.question_assertiveness()),
+            "refusal_rates": self.per_question(self.refusal_rates()),
+            "failure_rates": self.per_question(self.failure_rates())
+        }
+        all_stats["dataset_discrepancy"] = get_average(all_stats["discrepancies"])
+        all_stats["cleaned_dataset_discrepancy"] = get_average(all_stats["cleaned_discrepancies"])
+        all_stats["dataset_assertiveness"] = get_average(all_stats["assertivenesses"])
+        all_stats["refusal_rate"] = get_average(all_stats["refusal_rates"])
+        all_stats["failure_rate"] = get_average(all_stats["failure_rates"])
+
+        all_stats["language_means"] = self.per_question_language(self.language_means())
+        all_stats["language_std"] = self.per_question_language(self.language_std())
+        all_stats["language_refusal_rate"] = self.per_language(self.language_refusal_rate())
+        all_stats["language_failure_rate"] = self.per_language(self.language_failure_rate())
+        all_stats["language_assertiveness"] = self.per_language(self.language_assertiveness())
+        all_stats["cleaned_language_assertiveness"] = self.per_language(self.language_assertiveness(cleaned=True))
+        return all_stats
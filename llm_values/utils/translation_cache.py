@@ -0,0 +1,125 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from decouple import config
+
+# (text, source language, target language, model)
+TranslationKey = tuple[str, str, str, str]
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    """Translations stored in one indexed SQLite file, safe for concurrent readers and writers (WAL mode).
+
+    Entries are keyed by (hash of source text, source language, target language, model).
+    If the cache grows beyond max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = None):
+        self.path = path or config("TRANSLATION_CACHE", default=".cache/translations.sqlite3")
+        self.max_entries = max_entries or config("TRANSLATION_CACHE_MAX_ENTRIES", default=1000000, cast=int)
+        self.local = threading.local()
+        self.puts_since_eviction = 0
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        with self.connection as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS translation (
+                    text_hash TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    translation TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (text_hash, source, target, model)
+                ) WITHOUT ROWID
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_translation_accessed ON translation (accessed)")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # One connection per thread (translations run in the thread pool of the llm client)
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    def get(self, text: str, source: str, target: str, model: str):
+        return self.get_many([(text, source, target, model)]).get((text, source, target, model))
+
+    def get_many(self, keys: list[TranslationKey], chunk_size: int = 500) -> dict[TranslationKey, str]:
+        """Look up many translations at once
+
+        :param keys: List of (text, source language, target language, model)
+        :return: Cached translations per key (misses are missing)
+        """
+        wanted = {(hash_text(text), source, target, model): (text, source, target, model)
+                  for text, source, target, model in keys}
+        hashes = list({hashed[0] for hashed in wanted})
+        found = {}
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            rows = self.connection.execute(
+                f"SELECT text_hash, source, target, model, translation FROM translation "
+                f"WHERE text_hash IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for text_hash, source, target, model, translation in rows:
+                key = wanted.get((text_hash, source, target, model))
+                if key is not None:
+                    found[key] = translation
+
+        if found:
+            now = time.time()
+            with self.connection as connection:
+                connection.executemany(
+                    "UPDATE translation SET accessed = ? WHERE text_hash = ? AND source = ? AND target = ? AND model = ?",
+                    [(now, hash_text(text), source, target, model) for text, source, target, model in found]
+                )
+        return found
+
+    def put(self, text: str, source: str, target: str, model: str, translation: str):
+        self.put_many({(text, source, target, model): translation})
+
+    def put_many(self, translations: dict[TranslationKey, str]):
+        now = time.time()
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO translation (text_hash, source, target, model, translation, size, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(hash_text(text), source, target, model, translation, len(translation.encode("utf-8")), now)
+                 for (text, source, target, model), translation in translations.items()]
+            )
+        self.puts_since_eviction += len(translations)
+        if self.puts_since_eviction >= 1000:
+            self.evict()
+
+    def evict(self, max_entries: int = None) -> int:
+        """Delete the least recently used entries beyond max_entries, return the number of deleted entries"""
+        max_entries = max_entries or self.max_entries
+        self.puts_since_eviction = 0
+        with self.connection as connection:
+            entries = connection.execute("SELECT count(*) FROM translation").fetchone()[0]
+            if entries <= max_entries:
+                return 0
+            connection.execute(
+                "DELETE FROM translation WHERE (text_hash, source, target, model) IN "
+                "(SELECT text_hash, source, target, model FROM translation ORDER BY accessed LIMIT ?)",
+                (entries - max_entries,)
+            )
+        return entries - max_entries
+
+    def stats(self) -> dict:
+        entries, size = self.connection.execute("SELECT count(*), coalesce(sum(size), 0) FROM translation").fetchone()
+        return {"entries": entries, "translation_bytes": size, "file_bytes": os.path.getsize(self.path)}
@@ -1,17 +1,20 @@
+import glob
+import os
 from io import BytesIO
 
-import matplotlib.pyplot as plt
-import matplotlib.cm
 import numpy as np
-from PIL import Image
-from joblib import Memory
+
+# matplotlib and PIL are imported on first use (not needed for the Vega-Lite charts of the app)
 
 cache_dir = ".cache/plots/"
 
-memory = Memory(cache_dir, verbose=0)
+# Increase if the plots change (cached plots of older versions are not used anymore)
+plot_version = 2
 
 
 def fig_to_pil(fig, dpi=600):
+    from PIL import Image
+
     buf = BytesIO()
     fig.savefig(buf, format='png', dpi=dpi, bbox_inches='tight', pad_inches=0.0)
     buf.seek(0)
@@ -19,25 +22,35 @@ def fig_to_pil(fig, dpi=600):
     return img
 
 
-def get_plot(question_stats, fname="", dpi=300, figsize=(10, 5)):
+def plot_language_means(means: dict, stds: dict, figsize=(10, 5)):
+    """Bar plot of the mean rating (with standard deviation) per language
+
+    :param means: Mean rating per language (None if there is no valid rating)
+    :param stds: Standard deviation of the ratings per language
+    """
+    import matplotlib.cm
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=figsize)
 
-    languages = list(question_stats[0].answers.keys())
-    means = []
-    stds = []
-    for language in languages:
-        ratings = [question_stats[i].ratings[language] for i in range(len(question_stats))]
-        ratings = [r for r in ratings if r is not None]
-        means.append(np.mean(ratings))
-        stds.append(np.std(ratings))
+    languages = list(means.keys())
+    mean_values = [np.nan if means[language] is None else means[language] for language in languages]
+    std_values = [np.nan if stds.get(language) is None else stds[language] for language in languages]
 
     # Creating bar plot
-    bars = ax.bar(languages, means, yerr=stds, capsize=5,
+    bars = ax.bar(languages, mean_values, yerr=std_values, capsize=5,
                   color=matplotlib.cm.get_cmap('tab20').colors[:len(languages)])
 
     ax.set_ylim([0, 9.5])
     plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")
     fig.subplots_adjust(bottom=0.2)
+    return fig
+
+
+def get_plot(means: dict, stds: dict, fname="", dpi=300, figsize=(10, 5)):
+    import matplotlib.pyplot as plt
+
+    fig = plot_language_means(means, stds, figsize)
 
     img = fig_to_pil(fig, dpi=dpi)
 
@@ -48,6 +61,84 @@ def get_plot(question_stats, fname="", dpi=300, figsize=(10, 5)):
     return img
 
 
-@memory.cache
-def get_plot_cached(question_stats, fname="", dpi=300):
-    return get_plot(question_stats, fname, dpi)
+def get_stats_version(setup) -> str:
+    """Version of the stats of a setup (changes whenever the stats are updated, see update_setup_stats)"""
+    return str(setup.stats_version or 0)
+
+
+def get_plot_path(setup, question) -> str:
+    return os.path.join(cache_dir, f"{setup.id}_{question.id}_{get_stats_version(setup)}_v{plot_version}.png")
+
+
+def render_setup_plot(setup, question, dpi=300):
+    """Render the plot of a question from the stats of a setup into the plot cache
+
+    Cached plots of older stats versions of the same setup and question are removed.
+    :return: Path of the PNG file (None if the setup has no stats for the question)
+    """
+    question_means = (setup.stats or {}).get("language_means", {}).get(str(question.number))
+    if not question_means:
+        return None
+    question_stds = setup.stats.get("language_std", {}).get(str(question.number), {})
+    import matplotlib.pyplot as plt
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_path = get_plot_path(setup, question)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    fig = plot_language_means(question_means, question_stds)
+    fig.savefig(tmp_path, format="png", dpi=dpi, bbox_inches="tight", pad_inches=0.0)
+    plt.close(fig)
+    os.replace(tmp_path, file_path)
+
+    for old_path in glob.glob(os.path.join(cache_dir, f"{setup.id}_{question.id}_*.png")):
+        if old_path != file_path:
+            os.remove(old_path)
+    return file_path
+
+
+def get_plot_cached(setup, question, dpi=300):
+    """Path of the pre-rendered plot of a question for a setup (rendered now if it is not cached yet)"""
+    file_path = get_plot_path(setup, question)
+    if os.path.exists(file_path):
+        return file_path
+    return render_setup_plot(setup, question, dpi)
+
+
+def get_chart_spec(setup, question) -> dict:
+    """Vega-Lite spec of the plot of a question for a setup (same chart as get_plot, rendered by the browser)
+
+    :return: Chart spec (None if the setup has no stats for the question)
+    """
+    question_means = (setup.stats or {}).get("language_means", {}).get(str(question.number))
+    if not question_means:
+        return None
+    question_stds = setup.stats.get("language_std", {}).get(str(question.number), {})
+
+    values = []
+    for language, mean in question_means.items():
+        std = question_stds.get(language) or 0.
+        values.append({
+            "language": language,
+            "mean": mean,
+            "lower": None if mean is None else mean - std,
+            "upper": None if mean is None else mean + std
+        })
+    return {
+        "data": {"values": values},
+        "encoding": {"x": {"field": "language", "type": "nominal", "sort": None, "title": None,
+                           "axis": {"labelAngle": -45}}},
+        "layer": [
+            {
+                "mark": "bar",
+                "encoding": {
+                    "y": {"field": "mean", "type": "quantitative", "title": None, "scale": {"domain": [0, 9.5]}},
+                    "color": {"field": "language", "type": "nominal", "sort": None, "legend": None,
+                              "scale": {"scheme": "tableau20"}}
+                }
+            },
+            {
+                "mark": {"type": "errorbar", "ticks": True},
+                "encoding": {"y": {"field": "lower", "type": "quantitative"}, "y2": {"field": "upper"}}
+            }
+        ]
+    }
@@ -0,0 +1,151 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.orm import Session
+
+from llm_values.models import get_engine, Answer, WorkItem
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# The ledger transactions of all setups run in one thread: they do not block the event loop and do not wait for each
+# other's SQLite write lock
+ledger_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="work_ledger")
+
+
+class WorkLedger:
+    """Checkpoints the LLM calls (question x repetition x language) of the answers of one setup in the work_item table
+
+    The result of every call is stored as soon as it is done. A run that crashed resumes with the repetitions that
+    are not stored yet, reuses their done calls and only repeats the pending, in-flight and failed ones. The work items
+    of an answer are removed when the answer is stored (see AnswerWriter).
+    The methods are synchronous, call them with run from the event loop.
+    """
+
+    def __init__(self, topic_id: int, model: str, temperature: float, max_tokens: int, rating_last: bool,
+                 answer_english: bool, question_english: bool):
+        self.topic_id = topic_id
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.rating_last = rating_last
+        self.answer_english = answer_english
+        self.question_english = question_english
+        self.setup_key = WorkItem.get_setup_key(
+            topic_id, model, temperature, max_tokens, rating_last, answer_english, question_english
+        )
+
+    @classmethod
+    def from_answer(cls, answer: Answer) -> "WorkLedger":
+        return cls(answer.topic_id, answer.model, answer.temperature, answer.max_tokens, answer.rating_last,
+                   answer.answer_english, answer.question_english)
+
+    @staticmethod
+    async def run(function, *args, **kwargs):
+        """Run a ledger method (or any function using the ledger) in the ledger thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            ledger_executor, functools.partial(function, *args, **kwargs)
+        )
+
+    def get_repetitions(self, question_id: int, count: int) -> list[int]:
+        """Repetitions for count new answers of a question: the unfinished ones of previous runs first, then new ones
+
+        Repetitions with a stored answer are never unfinished (their work items belong to a repair of the answer).
+        """
+        with Session(get_engine()) as session:
+            stored = set(session.scalars(select(Answer.repetition).where(
+                *Answer.setup_filter(self.topic_id, self.model, self.temperature, self.rating_last,
+                                     self.answer_english, self.question_english, question_id=question_id,
+                                     max_tokens=self.max_tokens),
+                Answer.repetition.is_not(None)
+            )).all())
+            unfinished = [repetition for repetition in session.scalars(
+                select(WorkItem.repetition).distinct()
+                .where(WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id)
+                .order_by(WorkItem.repetition)
+            ).all() if repetition not in stored]
+        start = max(unfinished + list(stored) + [-1]) + 1
+        return (unfinished + list(range(start, start + count)))[:max(count, 0)]
+
+    def add(self, question_id: int, repetitions: list[int], languages: list[str]):
+        """Register the calls of new answers as pending (existing work items are kept)"""
+        with Session(get_engine()) as session:
+            existing = set(session.execute(
+                select(WorkItem.repetition, WorkItem.language)
+                .where(WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id)
+            ).all())
+            session.add_all([
+                WorkItem(setup_key=self.setup_key, question_id=question_id, repetition=repetition, language=language,
+                         status=PENDING, attempts=0)
+                for repetition in repetitions for language in languages if (repetition, language) not in existing
+            ])
+            session.commit()
+
+    def get_results(self, question_id: int, repetition: int) -> dict[str, str]:
+        """Results of the done calls of an answer per language"""
+        with Session(get_engine()) as session:
+            return dict(session.execute(
+                select(WorkItem.language, WorkItem.result).where(
+                    WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id,
+                    WorkItem.repetition == repetition, WorkItem.status == DONE
+                )
+            ).all())
+
+    def update(self, question_id: int, repetition: int, languages: list[str], status: str, result: str = None,
+               error: str = None):
+        # One UPDATE statement per checkpoint (called for every LLM call)
+        values = {"status": status, "result": result, "error": error, "timestamp": datetime.utcnow()}
+        if status == IN_FLIGHT:
+            values["attempts"] = WorkItem.attempts + 1
+        with get_engine().begin() as connection:
+            connection.execute(update(WorkItem).where(
+                WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id,
+                WorkItem.repetition == repetition, WorkItem.language.in_(languages)
+            ).values(**values))
+
+    def start(self, question_id: int, repetition: int, languages: list[str]):
+        self.update(question_id, repetition, languages, IN_FLIGHT)
+
+    def done(self, question_id: int, repetition: int, language: str, result: str):
+        self.update(question_id, repetition, [language], DONE, result=result)
+
+    def failed(self, question_id: int, repetition: int, language: str, error: Exception):
+        self.update(question_id, repetition, [language], FAILED, error=str(error))
+
+    def remove(self, question_id: int, repetition: int):
+        """Remove the work items of an answer (e.g. after a failed repair, the failed cells are kept in the answer)"""
+        with get_engine().begin() as connection:
+            connection.execute(delete(WorkItem).where(
+                WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id,
+                WorkItem.repetition == repetition
+            ))
+
+    def clear(self, question_id: int):
+        """Remove the work items of a question (its answers are queried again from scratch)"""
+        with Session(get_engine()) as session:
+            session.execute(delete(WorkItem).where(
+                WorkItem.setup_key == self.setup_key, WorkItem.question_id == question_id
+            ))
+            session.commit()
+
+    def get_status_counts(self) -> dict[str, int]:
+        with Session(get_engine()) as session:
+            return dict(session.execute(
+                select(WorkItem.status, func.count()).where(WorkItem.setup_key == self.setup_key)
+                .group_by(WorkItem.status)
+            ).all())
+
+
+def remove_stored(session: Session, answers: list[Answer]):
+    """Remove the work items of stored answers (call in the transaction that stores them)"""
+    for answer in answers:
+        if answer.repetition is not None:
+            session.execute(delete(WorkItem).where(
+                WorkItem.setup_key == answer.setup_key, WorkItem.question_id == answer.question_id,
+                WorkItem.repetition == answer.repetition
+            ))
@@ -13,6 +13,10 @@ setuptools.setup(
     url="https://github.com/straeter/llm_values",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    extras_require={
+        "export": ["zstandard", "pyarrow"],
+        "test": ["pytest"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,209 @@
+import asyncio
+
+import pytest
+from sqlalchemy.orm import Session, selectinload
+
+from llm_values import models
+from llm_values.models import get_engine, init_db, Answer, AnswerCell, Question, Topic, WorkItem
+from llm_values.pipeline import step_2_query_llms
+from llm_values.pipeline.step_2_query_llms import query_answers
+from llm_values.utils.answer_writer import AnswerWriter
+from llm_values.utils.work_ledger import WorkLedger, remove_stored, DONE, FAILED, IN_FLIGHT
+
+languages = ["English", "German", "French"]
+formats = tuple({language: f"{name} {language}" for language in languages}
+                for name in ["prefix", "format", "prefix re", "format re"])
+settings = dict(model="gpt-4o", temperature=0.0, max_tokens=100, rating_last=False, answer_english=False,
+                question_english=False)
+
+
+@pytest.fixture
+def question(tmp_path, monkeypatch):
+    """Question of a topic in a new temporary SQLite database (DATABASE_URL)"""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(models, "_engine", None)
+    init_db()
+    with Session(get_engine(), expire_on_commit=False) as session:
+        topic = Topic(name="topic", description="")
+        question = Question(name="question", description="", mode="values", question="question", topic=topic,
+                            translations={language: f"question {language}" for language in languages})
+        session.add(question)
+        session.commit()
+    yield question
+    get_engine().dispose()
+
+
+class FakeLLM:
+    """Replaces api_call: answers with a rating, fails or hangs (crash) for the given languages"""
+
+    def __init__(self, failing: tuple = (), hanging: tuple = ()):
+        self.failing = failing
+        self.hanging = hanging
+        self.calls = []
+
+    async def __call__(self, new_answer, language, formats):
+        self.calls.append(language)
+        if language in self.hanging:
+            await asyncio.sleep(3600)
+        if language in self.failing:
+            raise Exception(f"No response in {language}")
+        return f"answer in {language} [[7]]"
+
+
+async def run(question: Question, num_queries: int = 1, overwrite: bool = False):
+    """Query and store the answers of a question (like query_question)"""
+    with AnswerWriter(languages) as writer:
+        for answer in await query_answers(question, languages, formats, topic_id=question.topic_id,
+                                          num_queries=num_queries, overwrite=overwrite, **settings):
+            writer.add(answer)
+    return writer
+
+
+def get_answers() -> list[Answer]:
+    with Session(get_engine()) as session:
+        return session.query(Answer).options(selectinload(Answer.cells)).order_by(Answer.id).all()
+
+
+def get_work_items() -> list[WorkItem]:
+    with Session(get_engine()) as session:
+        return session.query(WorkItem).all()
+
+
+def test_resume_after_crash(question, monkeypatch):
+    llm = FakeLLM(hanging=("German",))
+    monkeypatch.setattr(step_2_query_llms, "api_call", llm)
+    ledger = WorkLedger(question.topic_id, **settings)
+
+    async def crash():
+        # The run is killed while German is in flight, after the other languages are done
+        task = asyncio.create_task(run(question))
+        while ledger.get_status_counts().get(DONE, 0) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(crash())
+    assert get_answers() == []
+    assert {(item.language, item.status) for item in get_work_items()} == {
+        ("English", DONE), ("French", DONE), ("German", IN_FLIGHT)
+    }
+
+    llm = FakeLLM()
+    monkeypatch.setattr(step_2_query_llms, "api_call", llm)
+    asyncio.run(run(question))
+
+    # Only the call in flight is repeated, the done ones are reused
+    assert llm.calls == ["German"]
+    [answer] = get_answers()
+    assert answer.repetition == 0
+    assert set(answer.answers) == set(languages)
+    assert {cell.status for cell in answer.cells} == {DONE}
+    assert get_work_items() == []
+
+
+def test_partial_language_failure(question, monkeypatch):
+    monkeypatch.setattr(step_2_query_llms, "api_call", FakeLLM(failing=("German",)))
+    writer = asyncio.run(run(question, num_queries=2))
+
+    assert writer.written == 2
+    for answer in get_answers():
+        cells = {cell.language: cell for cell in answer.cells}
+        assert cells["German"].status == FAILED
+        assert cells["German"].error == "No response in German"
+        assert cells["English"].status == cells["French"].status == DONE
+        assert set(answer.answers) == set(answer.ratings) == {"English", "French"}
+    # The work items of the stored answers are removed, also the ones of the failed languages
+    assert get_work_items() == []
+
+
+def test_all_languages_failed(question, monkeypatch):
+    monkeypatch.setattr(step_2_query_llms, "api_call", FakeLLM(failing=tuple(languages)))
+    writer = asyncio.run(run(question))
+
+    # Answers without any response are not stored, their calls are repeated in the next run
+    assert writer.written == 0
+    assert get_answers() == []
+    assert {item.status for item in get_work_items()} == {FAILED}
+
+
+def test_rerun_queries_only_failed_cells(question, monkeypatch):
+    monkeypatch.setattr(step_2_query_llms, "api_call", FakeLLM(failing=("German",)))
+    asyncio.run(run(question, num_queries=2))
+    answer_ids = [answer.id for answer in get_answers()]
+
+    llm = FakeLLM()
+    monkeypatch.setattr(step_2_query_llms, "api_call", llm)
+    writer = asyncio.run(run(question, num_queries=2))
+
+    assert sorted(llm.calls) == ["German", "German"]
+    assert (writer.written, writer.repaired) == (0, 2)
+    answers = get_answers()
+    assert [answer.id for answer in answers] == answer_ids
+    for answer in answers:
+        assert {cell.status for cell in answer.cells} == {DONE}
+        assert len(answer.cells) == len(languages)
+        assert answer.ratings == {language: 7 for language in languages}
+    assert get_work_items() == []
+
+    # Nothing is queried once all cells are done
+    llm.calls.clear()
+    asyncio.run(run(question, num_queries=2))
+    assert llm.calls == []
+
+
+def test_failed_repair(question, monkeypatch):
+    monkeypatch.setattr(step_2_query_llms, "api_call", FakeLLM(failing=("German",)))
+    asyncio.run(run(question))
+
+    # The repair fails again: the answer keeps its failed cell, nothing is left in the ledger
+    llm = FakeLLM(failing=("German",))
+    monkeypatch.setattr(step_2_query_llms, "api_call", llm)
+    writer = asyncio.run(run(question))
+
+    assert llm.calls == ["German"]
+    assert (writer.written, writer.repaired) == (0, 0)
+    [answer] = get_answers()
+    assert {cell.language: cell.status for cell in answer.cells}["German"] == FAILED
+    assert get_work_items() == []
+
+
+def test_more_queries_after_failed_repair(question, monkeypatch):
+    monkeypatch.setattr(step_2_query_llms, "api_call", FakeLLM(failing=("German",)))
+    asyncio.run(run(question))
+    asyncio.run(run(question))
+
+    # The stored answer is repaired, one new answer is queried (with a new repetition)
+    llm = FakeLLM()
+    monkeypatch.setattr(step_2_query_llms, "api_call", llm)
+    writer = asyncio.run(run(question, num_queries=2))
+
+    assert sorted(llm.calls) == sorted(languages + ["German"])
+    assert (writer.written, writer.repaired) == (1, 1)
+    answers = get_answers()
+    assert [answer.repetition for answer in answers] == [0, 1]
+    assert all(cell.status == DONE for answer in answers for cell in answer.cells)
+    assert get_work_items() == []
+
+
+def test_remove_stored_in_same_transaction(question):
+    ledger = WorkLedger(question.topic_id, **settings)
+    ledger.add(question.id, [0, 1], languages)
+    answer = Answer(question_id=question.id, topic_id=question.topic_id, repetition=0, prompts={},
+                    answers={"English": "[[7]]"}, ratings={"English": 7},
+                    cells=[AnswerCell(language="English", status=DONE, rating=7)], **settings)
+
+    # Nothing is removed if the answer is not stored
+    with Session(get_engine()) as session:
+        session.add(answer)
+        remove_stored(session, [answer])
+        session.rollback()
+    assert len(get_work_items()) == 2 * len(languages)
+    assert get_answers() == []
+
+    with Session(get_engine()) as session:
+        session.add(answer)
+        remove_stored(session, [answer])
+        session.commit()
+    assert {item.repetition for item in get_work_items()} == {1}
+    assert len(get_answers()) == 1